@@ -1,8 +1,132 @@
 from random import choice
 from string import ascii_uppercase
-from datetime import datetime
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from os import environ, getpid
+from socket import gethostname
+from fnmatch import fnmatch
+from time import sleep, time
+from weakref import WeakKeyDictionary
+
+from cachelib import load_json, save_json, file_md5
+from metricslib import metrics
+
+# how many uploads run at the same time, unless told otherwise
+UPLOAD_CONCURRENCY = 8
+# digests of local files, so unchanged files are not read again
+UPLOAD_MANIFEST = 'uploads.json'
+# concurrent describe_cluster calls and how many times a throttled call is
+# tried before giving up
+DESCRIBE_CONCURRENCY = 8
+DESCRIBE_MAX_ATTEMPTS = 10
+# the tagging API is eventually consistent, it can take a few minutes to
+# know about a new cluster. clusters this recent are described instead
+TAGGING_LAG_SECONDS = 300
+# what 'on' and 'off' mean for a cluster
+CLUSTER_STATES_ON = ['STARTING', 'BOOTSTRAPPING', 'RUNNING', 'WAITING']
+CLUSTER_STATES_OFF = ['TERMINATING', 'TERMINATED', 'TERMINATED_WITH_ERRORS']
+# how many clusters are terminated with one API call
+TERMINATE_BATCH_SIZE = 100
+# add_job_flow_steps accepts this many steps per call, and a cluster this
+# many PENDING and RUNNING steps at once
+STEPS_PER_CALL = 256
+MAX_ACTIVE_STEPS = 256
+# seconds between checks when a cluster has no room for more steps
+STEPS_POLL_INTERVAL = 30
+# shortest and longest wait between two checks of a cluster being watched
+WATCH_MIN_INTERVAL = 5
+WATCH_MAX_INTERVAL = 120
+# how long clusters usually stay in a state. polling gets more frequent as
+# the end of that time gets closer
+CLUSTER_STATE_SECONDS = {'STARTING': 420, 'BOOTSTRAPPING': 180,
+        'TERMINATING': 120}
+STEP_STATES_ACTIVE = ['PENDING', 'RUNNING', 'CANCEL_PENDING']
+STEP_STATES_FAILED = ['FAILED', 'CANCELLED', 'INTERRUPTED']
+# most steps a cluster runs at the same time, for EMR
+MAX_STEP_CONCURRENCY = 256
+# list_steps accepts this many step IDs
+LIST_STEPS_MAX_IDS = 10
+# warm pool tags: the fingerprint of the cluster's setup, and who's using it
+POOL_TAG = 'emrer_pool'
+LEASE_TAG = 'emrer_lease'
+# a claimed cluster is left alone this many seconds, enough for the steps
+# that were sent to it to make it busy. after that it's free when WAITING
+LEASE_SECONDS = 300
+# seconds between writing a lease and reading it back, to see if another
+# emrer process claimed the same cluster at the same time
+LEASE_SETTLE_SECONDS = 2
+# emr_unique_name -> cluster id, and for how many seconds an entry is trusted
+CLUSTER_CACHE = 'clusters.json'
+CLUSTER_CACHE_TTL = int(environ.get('EMRER_CLUSTER_CACHE_TTL', 24 * 3600))
+# release labels and AMI ids that were looked up, and for how many seconds
+# they are trusted
+LOOKUP_CACHE = 'lookups.json'
+LOOKUP_CACHE_TTL = int(environ.get('EMRER_LOOKUP_CACHE_TTL', 24 * 3600))
+# the release used when a configuration doesn't name one. 'latest' is
+# opt-in, newer releases don't support the default instance types
+DEFAULT_RELEASE_LABEL = 'emr-4.3.0'
+# the image 'latest' means, see get_amazon_linux_ami()
+AMI_NAME_PATTERN = 'amzn2-ami-hvm-*-gp2'
+AMI_ARCHITECTURE = 'x86_64'
+
+
+def get_session(profile=None, region=None):
+    """Returns a new boto3 session for an aws credentials profile
+
+    The session uses the profile's region, unless a region is given.
+    boto3 is imported here, and not when the module is loaded, because it
+    takes longer to import than most emrer commands take to run. API calls
+    made through the session are counted, see metricslib.
+
+    Sessions are made by the factory set with set_session_factory(), if
+    any. Everything in emrer gets its sessions from here.
+    """
+    if _session_factory is not None:
+        session = _session_factory(profile, region)
+    else:
+        import boto3
+        session = boto3.session.Session(profile_name=profile,
+                region_name=region)
+    metrics.attach(session)
+    return session
+
+# makes sessions instead of boto3, see set_session_factory()
+_session_factory = None
+
+
+def set_session_factory(factory):
+    """Changes how get_session() makes sessions
+
+    Args:
+        factory: called as factory(profile, region), returns a boto3
+            session or anything that works like one. None goes back to
+            plain boto3 sessions. See fakeaws for a factory that needs no
+            AWS account
+
+    Returns:
+        the factory that was used until now
+    """
+    global _session_factory
+    previous, _session_factory = _session_factory, factory
+    return previous
+
+
+def s3_rand_key(prefix=None, postfix=None, rand_length=12):
+    """
+    Generates an S3 key made of a prefix, a random string and a postfix.
+
+    Args:
+        prefix (str): prepended to the random string, acts as 'path' on S3
+        postfix (str): appended to the random string
+        rand_length (int): length of the random string, 0 for none
+
+    Returns:
+        the S3 key, as a string
+    """
+    rand = ''.join(choice(ascii_uppercase) for i in range(rand_length))
+    return '{0}{1}{2}'.format(prefix or '', rand, postfix or '')
 
-from boto3.s3.transfer import S3Transfer
 
 def upload_to_s3_rand(session, file_to_upload, s3bucket, 
         prefix=None, postfix=None, rand_length=12):
@@ -22,49 +146,294 @@ def upload_to_s3_rand(session, file_to_upload, s3bucket,
     Returns:
         name of the S3 object, None if it fails
     """
-    rand = ''.join(choice(ascii_uppercase) for i in range(rand_length))
-    s3key = '{0}{1}{2}'.format(prefix or '', rand, postfix or '')
-    s3c = session.client('s3')
-    s3transfer = S3Transfer(s3c)
+    s3key = s3_rand_key(prefix, postfix, rand_length)
+    s3transfer = get_s3_transfer(session)[1]
 
     s3transfer.upload_file(file_to_upload, s3bucket, s3key)
 
     return '{}/{}'.format(s3bucket, s3key)
 
 
-def get_amazon_linux_ami(latest=True):
+def get_s3_transfer(session, settings=None):
+    """Returns the S3 client and transfer manager used for a session
+
+    There is one transfer manager per session, shared by all uploads, so
+    that connections are reused and all uploads together are limited by
+    its max_concurrency. Settings can be passed on the first call, usually
+    from the 'transfer' section of the configuration file. Passing different
+    settings later replaces the transfer manager.
+
+    Args:
+        session (boto3.session): session to create the S3 client from
+        settings (dict): any of
+            multipart_threshold: files at least this big are uploaded in
+                parts, in parallel. Bytes, or a string like '64MB'
+            multipart_chunksize: size of each part
+            max_concurrency: parts/files transferred at the same time
+            max_pool_connections: size of the HTTP connection pool. Default
+                is max_concurrency + UPLOAD_CONCURRENCY, enough for all
+                transfers plus the head_object calls of the upload cache
+
+    Returns:
+        (S3 client, S3Transfer) tuple
+    """
+    if session in _s3_transfers and (settings is None
+            or _s3_transfers[session][0] == settings):
+        return _s3_transfers[session][1:]
+    from boto3.s3.transfer import S3Transfer, TransferConfig
+    from botocore.config import Config
+
+    settings = dict(settings or {})
+    config = {}
+    for setting in ['multipart_threshold', 'multipart_chunksize']:
+        if setting in settings:
+            config[setting] = parse_size(settings[setting])
+    if 'max_concurrency' in settings:
+        config['max_concurrency'] = int(settings['max_concurrency'])
+    transfer_config = TransferConfig(**config)
+    pool_size = int(settings.get('max_pool_connections',
+            transfer_config.max_request_concurrency + UPLOAD_CONCURRENCY))
+
+    s3c = session.client('s3',
+            config=Config(max_pool_connections=pool_size))
+    s3transfer = S3Transfer(s3c, transfer_config)
+    _s3_transfers[session] = (settings, s3c, s3transfer)
+    return s3c, s3transfer
+
+# session -> (settings, S3 client, S3Transfer), see get_s3_transfer()
+_s3_transfers = WeakKeyDictionary()
+
+
+def parse_size(size):
+    """Converts sizes like 512, '64KB', '8MB' or '1GB' to bytes"""
+    if isinstance(size, int):
+        return size
+    size = str(size).strip().upper()
+    for suffix, multiplier in [('KB', 1024), ('MB', 1024 ** 2),
+            ('GB', 1024 ** 3), ('B', 1)]:
+        if size.endswith(suffix):
+            return int(float(size[:-len(suffix)]) * multiplier)
+    return int(size)
+
+
+def upload_files_to_s3(session, uploads, max_workers=UPLOAD_CONCURRENCY,
+        use_cache=True):
     """
-    A dummy function for now, when developped it should return one and only
-    one id of an Amazon Linux AMI to be used. Arguments can be passed on to
-    to identify the exact image. 'latest' should return the newest version
-    of Amazon Linux, HVM, EBS-Backed, 64-bit (the most used image),
-    depending on region.
+    Uploads a number of files to S3 at the same time, using a bounded pool
+    of threads. All uploads go through the session's transfer manager, see
+    get_s3_transfer().
 
-    Check this page on how to find the Linux AMI:
-    http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/finding-an-ami.html
+    Uploads are content addressed. The MD5 of each file is stored on the
+    object as 'emrer-md5' metadata. A file is not uploaded again if the
+    object on S3 has the same digest in its metadata or ETag, which costs
+    one head_object call. The MD5s of local files are kept in a manifest
+    (see cachelib), so files that didn't change are not read again.
 
-    Here's how to filter images from the command line:
-    aws --profile bf_edcdev_luputb ec2 describe-images --owners self amazon \
-            --filters "Name=root-device-type,Values=ebs" \
-                "Name=virtualization-type,Values=hvm" \
-                "Name=architecture,Values=x86_64"
+    Args:
+        session (boto3.session): session used to create the S3 client
+        uploads (list): (local file, bucket, key) tuples. The same tuple
+            showing up more than once is uploaded only once
+        max_workers (int): maximum number of uploads running at once
+        use_cache (bool): if False, upload everything no matter what
+
+    Returns:
+        list of 'bucket/key' strings, in the order the uploads were received
     """
-    return 'ami-0eac257d'
+    if not uploads:
+        return []
+    s3c, s3transfer = get_s3_transfer(session)
+    manifest = load_json(UPLOAD_MANIFEST, {})
+    manifest.setdefault('files', {})
+
+    def upload(upload):
+        file_to_upload, s3bucket, s3key = upload
+        # threads only get and set single keys in the manifest, which is
+        # safe without a lock
+        md5 = file_md5(file_to_upload, manifest['files'])
+        # the object may have been deleted or overwritten since the last
+        # upload, only S3 knows
+        if use_cache and s3_object_md5(s3c, s3bucket, s3key) == md5:
+            return True
+        s3transfer.upload_file(file_to_upload, s3bucket, s3key,
+                extra_args={'Metadata': {'emrer-md5': md5}})
+        return False
 
+    unique_uploads = list(dict.fromkeys(uploads))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # list() makes sure an exception in any upload is raised here
+        list(executor.map(upload, unique_uploads))
+    save_json(UPLOAD_MANIFEST, manifest)
 
-def get_emr_release_label():
+    return ['{}/{}'.format(s3bucket, s3key) for _, s3bucket, s3key in uploads]
+
+
+def s3_object_md5(s3c, s3bucket, s3key):
     """
-    dummy function
-    At some point it will return a release label depnding on passed parameters.
-    'latest' should be a valid parameter, probably the default
+    Returns the MD5 of an S3 object's content without downloading it, or
+    None if it can't be determined. The digest is read from the 'emrer-md5'
+    metadata set by upload_files_to_s3, falling back to the ETag, which is
+    the MD5 for objects that were not uploaded in multiple parts.
+
+    Args:
+        s3c (boto3.client): S3 client
+        s3bucket (str): bucket name
+        s3key (str): object key
+
+    Returns:
+        hex digest as a string, or None
+    """
+    from botocore.exceptions import ClientError
+    try:
+        head = s3c.head_object(Bucket=s3bucket, Key=s3key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+            return None
+        raise
+    if 'emrer-md5' in head.get('Metadata', {}):
+        return head['Metadata']['emrer-md5']
+    etag = head.get('ETag', '').strip('"')
+    if '-' in etag:
+        # multipart upload, the ETag is not the MD5 of the content
+        return None
+    return etag or None
+
+
+def _cached_lookup(session, name, fetch):
+    """
+    Returns the result of a lookup that rarely changes, from the cache in
+    LOOKUP_CACHE if it's younger than LOOKUP_CACHE_TTL, otherwise from
+    fetch(), caching it. Lookups are per profile and region.
     """
-    return 'emr-4.3.0'
+    key = '{}:{}:{}'.format(session.profile_name, session.region_name, name)
+    entry = load_json(LOOKUP_CACHE, {}).get(key)
+    if entry and time() - entry['time'] < LOOKUP_CACHE_TTL:
+        return entry['value']
+    value = fetch()
+    # read again, another emrer process may have written it meanwhile
+    cache = load_json(LOOKUP_CACHE, {})
+    cache[key] = {'value': value, 'time': time()}
+    save_json(LOOKUP_CACHE, cache)
+    return value
+
+
+def is_lookup(value):
+    """Whether a release label or AMI id has to be looked up"""
+    return value == 'latest' or '*' in value
 
-def get_cluster_ids(session, state=None, states=[], 
+
+def get_amazon_linux_ami(session, name='latest',
+        architecture=AMI_ARCHITECTURE):
+    """
+    Returns the id of the newest Amazon Linux image matching a name, HVM
+    and EBS-backed, in the session's region. The search is done with
+    describe_images filters, so only matching images are returned by AWS,
+    and its result is cached, see _cached_lookup().
+
+    Args:
+        session (boto3.session): session to use
+        name (str): image name pattern, 'latest' for AMI_NAME_PATTERN. An
+            AMI id is returned as it is
+        architecture (str): x86_64 or arm64
+
+    Returns:
+        an AMI id
+    """
+    if not is_lookup(name):
+        return name
+    if name == 'latest':
+        name = AMI_NAME_PATTERN
+
+    def fetch():
+        ec2 = session.client('ec2')
+        images = []
+        for page in ec2.get_paginator('describe_images').paginate(
+                Owners=['amazon'], Filters=[
+                    {'Name': 'name', 'Values': [name]},
+                    {'Name': 'architecture', 'Values': [architecture]},
+                    {'Name': 'root-device-type', 'Values': ['ebs']},
+                    {'Name': 'virtualization-type', 'Values': ['hvm']},
+                    {'Name': 'state', 'Values': ['available']}]):
+            images.extend(page['Images'])
+        if not images:
+            raise RuntimeError('No Amazon Linux image named {} ({})'.format(
+                name, architecture))
+        return max(images, key=lambda image: image['CreationDate'])['ImageId']
+
+    return _cached_lookup(session, 'ami:{}:{}'.format(name, architecture),
+            fetch)
+
+
+def release_version(label):
+    """Returns the version in a release label as a tuple, for sorting"""
+    version = label.split('-', 1)[-1]
+    return tuple(int(part) if part.isdigit() else -1
+            for part in version.split('.'))
+
+
+def get_emr_release_label(session, label='latest'):
+    """
+    Returns the newest EMR release label matching a pattern: 'latest' for
+    the newest release, or a prefix like 'emr-6.*'. The labels are listed
+    with list_release_labels, filtered by the prefix, and cached, see
+    _cached_lookup(). Any other label is returned as it is, without
+    calling AWS.
+
+    Args:
+        session (boto3.session): session to use
+        label (str): 'latest', a pattern or a release label
+
+    Returns:
+        a release label
+    """
+    if not is_lookup(label):
+        return label
+    prefix = '' if label == 'latest' else label.split('*')[0]
+
+    def fetch():
+        emr = session.client('emr')
+        labels = []
+        kwargs = {'Filters': {'Prefix': prefix}} if prefix else {}
+        while True:
+            response = emr.list_release_labels(**kwargs)
+            labels.extend(response.get('ReleaseLabels', []))
+            if not response.get('NextToken'):
+                return labels
+            kwargs['NextToken'] = response['NextToken']
+
+    labels = [found for found in _cached_lookup(session,
+            'release_labels:{}'.format(prefix), fetch)
+            if fnmatch(found, label if prefix else '*')]
+    if not labels:
+        raise RuntimeError('No EMR release matches {}'.format(label))
+    return max(labels, key=release_version)
+
+def get_cluster_ids(session, state=None, states=None, 
         created_after=datetime.min, created_before=datetime.max,
-        tags_any={}, tags_all={}):
+        tags_any={}, tags_all={}, tag_lookup='bulk',
+        max_workers=DESCRIBE_CONCURRENCY):
     """Returns a list of clusters that satisfy parameters
 
+    Same as iter_clusters(), except that it returns a list of cluster IDs
+    instead of cluster summaries. See iter_clusters() for the arguments.
+
+    Returns:
+        list of cluster IDs
+    """
+    return [cluster['Id'] for cluster in iter_clusters(session, state, states,
+            created_after, created_before, tags_any, tags_all, tag_lookup,
+            max_workers)]
+
+
+def iter_clusters(session, state=None, states=None, 
+        created_after=datetime.min, created_before=datetime.max,
+        tags_any={}, tags_all={}, tag_lookup='bulk',
+        max_workers=DESCRIBE_CONCURRENCY):
+    """Yields the clusters that satisfy parameters
+
+    Clusters are yielded as soon as the list_clusters page they are on was
+    received, so the caller can stop early, e.g. when looking for one
+    cluster only. No more pages are requested after that.
+
     Args:
         state (str): Shortcut for cluster states. Can be either 'on' or 'off'. 
             'on' means ['STARTING','BOOTSTRAPPING','RUNNING','WAITING']
@@ -80,68 +449,715 @@ def get_cluster_ids(session, state=None, states=[],
             will be added to the list.
         tags_all (dict): all tags must exist on the cluster for it to 
             make the cut.
+        tag_lookup (str): how tags are matched. 'bulk' asks the resource
+            groups tagging API for all clusters having the tags, which takes
+            a handful of calls. The API doesn't know about clusters younger
+            than TAGGING_LAG_SECONDS yet, those are described. 'describe'
+            calls describe_cluster for every cluster, which is slower but
+            doesn't need tagging API permissions. 'bulk' turns into
+            'describe' if the tagging API can't be used.
+        max_workers (int): number of describe_cluster calls made at the same
+            time when tag_lookup is 'describe'
 
-    Returns:
-        list of cluster IDs
+    Yields:
+        cluster summaries, as returned by list_clusters
     """
-    cluster_ids = []
+    # don't change the list we received
+    states = list(states or [])
     
     if state == 'on':
-        states.extend(['STARTING','BOOTSTRAPPING','RUNNING','WAITING'])
+        states.extend(CLUSTER_STATES_ON)
     elif state == 'off':
-        states.extend(['TERMINATING','TERMINATED','TERMINATED_WITH_ERRORS'])
+        states.extend(CLUSTER_STATES_OFF)
     else:
         pass 
-    
+
+    tagged_ids = None
+    if tag_lookup == 'bulk' and (tags_any or tags_all):
+        from botocore.exceptions import ClientError
+        try:
+            tagged_ids = get_tagged_cluster_ids(session, tags_any, tags_all)
+        except ClientError as e:
+            if not is_access_denied(e):
+                raise
+    # clusters created after this may not be known to the tagging API
+    recent_after = datetime.fromtimestamp(time() - TAGGING_LAG_SECONDS,
+            timezone.utc)
+    if tagged_ids is not None and not tagged_ids:
+        # only the recent clusters can still match
+        if created_after.tzinfo is None:
+            created_after = created_after.replace(tzinfo=timezone.utc)
+        created_after = max(created_after, recent_after)
+
     emr = session.client('emr')
     paginator = emr.get_paginator('list_clusters')
-    for page in paginator.paginate(CreatedAfter=created_after, 
+    pages = paginator.paginate(CreatedAfter=created_after, 
             CreatedBefore=created_before,
-            ClusterStates=states):
-        for cluster in page['Clusters']:
-            cluster_ids.append(cluster['Id'])
-    # If no other condition was specified, there is no point in going through
-    # the whole list looking for nothing. return the list as we have it.
-    # WILL NEED TO BE ADJUSTED IF MORE ARGUMENTS ARE ADDED
-    # (there's probably a better way, but not going to bother yet)
+            ClusterStates=states)
+
+    # If no tags were asked for, there is no point in going through each
+    # page looking for nothing. yield everything as we get it.
     if len(tags_any) == 0 and len(tags_all) == 0:
-        return cluster_ids
-    
-    # There are additional filters to apply. Go through the list, describe
-    # each cluster and test againist filters. First failure, remove it
-    # from the list and move on. 
-    # We have to iterate over a copy of the list, otherwise the remove()
-    # will cause the loop to jump over clusters
-    for cluster_id in list(cluster_ids):
-        keep_cluster = False
-        cluster = emr.describe_cluster(ClusterId=cluster_id)['Cluster']
-        # check tags
-        c_tags = cluster['Tags']
-        # first, tags_any. first tag found, continue to next filter
-        # if no tag found, remove from list and move to next cluster
-        if len(tags_any) > 0:
-            for c_tag in c_tags:
-                if c_tag['Key'] in tags_any.keys() and \
-                        c_tag['Value'] == tags_any[c_tag['Key']]:
-                    keep_cluster = True
-                    break
-            if not keep_cluster:
-                cluster_ids.remove(cluster_id)
-                continue
-        # next, tags_all
-        keep_cluster = True
-        for key in tags_all.keys():
-            tag_found = False
-            for c_tag in c_tags:
-                if c_tag['Key'] == key and c_tag['Value'] == tags_all[key]:
-                    tag_found = True
-                    break
-            if not tag_found:
-                keep_cluster = False
+        for page in pages:
+            for cluster in page['Clusters']:
+                yield cluster
+        return
+
+    def is_recent(cluster):
+        return cluster['Status']['Timeline']['CreationDateTime'] \
+                >= recent_after
+
+    def describe(cluster):
+        return emr.describe_cluster(ClusterId=cluster['Id'])['Cluster']
+
+    if tagged_ids is not None:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for page in pages:
+                recent = [cluster for cluster in page['Clusters']
+                        if cluster['Id'] not in tagged_ids
+                        and is_recent(cluster)]
+                matching = set(cluster['Id'] for cluster, details
+                        in zip(recent, executor.map(describe, recent))
+                        if tags_match(details['Tags'], tags_any, tags_all))
+                for cluster in page['Clusters']:
+                    if cluster['Id'] in tagged_ids:
+                        tagged_ids.discard(cluster['Id'])
+                        yield cluster
+                    elif cluster['Id'] in matching:
+                        yield cluster
+                # clusters come newest first. once all tagged clusters and
+                # all recent ones were seen, the rest of the pages can't
+                # contain anything we're looking for
+                if not tagged_ids and (not page['Clusters']
+                        or not is_recent(page['Clusters'][-1])):
+                    return
+        return
+
+    # Describe each cluster and test it against the filters. The calls go
+    # through a pool of threads. The client uses botocore's 'adaptive' retry
+    # mode: throttled calls are retried and a client side token bucket slows
+    # all threads down to the rate EMR accepts
+    from botocore.config import Config
+    emr = session.client('emr', config=Config(retries={
+            'mode': 'adaptive', 'max_attempts': DESCRIBE_MAX_ATTEMPTS}))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for page in pages:
+            described = executor.map(describe, page['Clusters'])
+            for cluster, details in zip(page['Clusters'], described):
+                if tags_match(details['Tags'], tags_any, tags_all):
+                    yield cluster
+
+
+def is_access_denied(error):
+    """Tells if a botocore ClientError is about missing permissions"""
+    return error.response.get('Error', {}).get('Code') \
+            in ['AccessDenied', 'AccessDeniedException']
+
+
+def tags_match(tags, tags_any={}, tags_all={}):
+    """Checks boto3 style tags against tags_any and tags_all
+
+    Args:
+        tags (list): [{'Key': x, 'Value': y}, ...] as returned by boto3
+        tags_any (dict): at least one of these has to be present, if any
+        tags_all (dict): all of these have to be present
+
+    Returns:
+        True if the tags match, False otherwise
+    """
+    tags = dict((tag['Key'], tag['Value']) for tag in tags)
+    if tags_any and not any(tags.get(key) == value
+            for key, value in tags_any.items()):
+        return False
+    return all(tags.get(key) == value for key, value in tags_all.items())
+
+
+def get_tagged_cluster_ids(session, tags_any={}, tags_all={}):
+    """Returns the IDs of EMR clusters tagged with the given tags
+
+    Uses the resource groups tagging API, which finds tagged resources
+    without having to look at each of them. One call (page) is made for
+    tags_all and one for each key in tags_any, since the API can only 'and'
+    different keys. Note that the API can take a little while to see the
+    tags of a cluster that was just created.
+
+    Args:
+        tags_any (dict): clusters having any of these tags are returned
+        tags_all (dict): clusters must have all of these tags
+
+    Returns:
+        set of cluster IDs
+    """
+    tagging = session.client('resourcegroupstaggingapi')
+    paginator = tagging.get_paginator('get_resources')
+
+    def lookup(tags):
+        ids = set()
+        tag_filters = [{'Key': key, 'Values': [value]}
+                for key, value in tags.items()]
+        for page in paginator.paginate(
+                ResourceTypeFilters=['elasticmapreduce:cluster'],
+                TagFilters=tag_filters):
+            for resource in page['ResourceTagMappingList']:
+                # arn:aws:elasticmapreduce:region:account:cluster/j-XXXXX
+                ids.add(resource['ResourceARN'].split('/')[-1])
+        return ids
+
+    cluster_ids = None
+    if tags_any:
+        cluster_ids = set()
+        for key, value in tags_any.items():
+            cluster_ids |= lookup({key: value})
+    if tags_all:
+        all_ids = lookup(tags_all)
+        cluster_ids = all_ids if cluster_ids is None else cluster_ids & all_ids
+    return cluster_ids or set()
+
+
+def find_cluster_ids(session, unique_name, max_ids=2):
+    """Returns the IDs of running clusters tagged with an emr_unique_name
+
+    Looks in the local cluster cache first. A cached cluster is confirmed
+    with one describe_cluster call: if it's still running and still has the
+    tag, its ID is returned right away. Otherwise, or if the entry is older
+    than CLUSTER_CACHE_TTL, the account is searched and the cache updated.
+
+    Args:
+        session (boto3.session): session to use
+        unique_name (str): value of the emr_unique_name tag
+        max_ids (int): stop searching after this many clusters were found.
+            The default of 2 is enough to tell if a name is really unique
+
+    Returns:
+        list of cluster IDs, empty if there is no such cluster running
+    """
+    cache = load_json(CLUSTER_CACHE, {})
+    key = _cluster_cache_key(session, unique_name)
+    entry = cache.get(key)
+    if entry and time() - entry['time'] < CLUSTER_CACHE_TTL:
+        from botocore.exceptions import ClientError
+        emr = session.client('emr')
+        try:
+            cluster = emr.describe_cluster(ClusterId=entry['id'])['Cluster']
+        except ClientError:
+            cluster = None
+        if cluster and cluster['Status']['State'] in CLUSTER_STATES_ON \
+                and tags_match(cluster['Tags'],
+                    tags_all={'emr_unique_name': unique_name}):
+            return [entry['id']]
+
+    cluster_ids = [cluster['Id'] for cluster in islice(iter_clusters(session,
+            state='on', tags_any={'emr_unique_name': unique_name}), max_ids)]
+    if len(cluster_ids) == 1:
+        cache_cluster_id(session, unique_name, cluster_ids[0])
+    elif entry:
+        forget_cluster_id(session, unique_name)
+    return cluster_ids
+
+
+def cache_cluster_id(session, unique_name, cluster_id):
+    """Remembers the ID of the cluster having an emr_unique_name"""
+    cache = load_json(CLUSTER_CACHE, {})
+    cache[_cluster_cache_key(session, unique_name)] = {
+            'id': cluster_id,
+            'time': time()
+    }
+    save_json(CLUSTER_CACHE, cache)
+
+
+def forget_cluster_id(session, unique_name):
+    """Removes an emr_unique_name from the cluster cache"""
+    cache = load_json(CLUSTER_CACHE, {})
+    if cache.pop(_cluster_cache_key(session, unique_name), None):
+        save_json(CLUSTER_CACHE, cache)
+
+
+def _cluster_cache_key(session, unique_name):
+    # the same unique name can be used in different accounts and regions
+    return '{}:{}:{}'.format(session.profile_name, session.region_name,
+            unique_name)
+
+
+def find_clusters_by_unique_names(session, unique_names):
+    """Looks up running clusters for many emr_unique_name values at once
+
+    Unlike find_cluster_ids(), which handles one name, this makes one pass
+    over the tagging API (up to 20 names per call) and one pass over the
+    running clusters, no matter how many names are received. Clusters too
+    recent for the tagging API are described, and all running clusters are
+    if the tagging API can't be used, see describe_unique_names().
+
+    Args:
+        session (boto3.session): session to use
+        unique_names (list): values of the emr_unique_name tag
+
+    Returns:
+        dictionary of unique name -> list of running cluster IDs
+    """
+    from botocore.exceptions import ClientError
+    found = dict((unique_name, []) for unique_name in unique_names)
+    try:
+        tagged = get_cluster_unique_names(session, unique_names)
+    except ClientError as e:
+        if not is_access_denied(e):
+            raise
+        tagged = {}
+        described = describe_unique_names(session)
+    else:
+        described = describe_unique_names(session,
+                datetime.fromtimestamp(time() - TAGGING_LAG_SECONDS,
+                    timezone.utc))
+    for cluster_id, unique_name in described.items():
+        tagged.pop(cluster_id, None)
+        if unique_name in found:
+            found[unique_name].append(cluster_id)
+    if tagged:
+        for cluster in iter_clusters(session, state='on'):
+            unique_name = tagged.pop(cluster['Id'], None)
+            if unique_name in found:
+                found[unique_name].append(cluster['Id'])
+            if not tagged:
                 break
-        if not keep_cluster:
-            cluster_ids.remove(cluster_id)
+    return found
+
+
+def describe_unique_names(session, created_after=datetime.min):
+    """Reads the emr_unique_name of running clusters, describing each one
+
+    Used for the clusters the tagging API may not know about yet, created
+    in the last TAGGING_LAG_SECONDS, which are usually few. Or for all of
+    them, when the tagging API can't be used.
+
+    Args:
+        session (boto3.session): session to use
+        created_after (datetime): only clusters created after this
+
+    Returns:
+        dictionary of cluster ID -> emr_unique_name, None for clusters
+        without one
+    """
+    emr = session.client('emr')
+    clusters = list(iter_clusters(session, state='on',
+            created_after=created_after))
+
+    def describe(cluster):
+        return emr.describe_cluster(ClusterId=cluster['Id'])['Cluster']
+
+    recent = {}
+    with ThreadPoolExecutor(max_workers=DESCRIBE_CONCURRENCY) as executor:
+        for details in executor.map(describe, clusters):
+            tags = dict((tag['Key'], tag['Value']) for tag in details['Tags'])
+            recent[details['Id']] = tags.get('emr_unique_name')
+    return recent
+
+
+def get_cluster_unique_names(session, unique_names):
+    """Finds the clusters tagged with any of the given emr_unique_name values
+
+    Uses the resource groups tagging API, up to 20 names per call. Clusters
+    are returned whatever their state.
+
+    Args:
+        session (boto3.session): session to use
+        unique_names (list): values of the emr_unique_name tag
+
+    Returns:
+        dictionary of cluster ID -> unique name
+    """
+    tagging = session.client('resourcegroupstaggingapi')
+    paginator = tagging.get_paginator('get_resources')
+    unique_names = sorted(set(unique_names))
+    tagged = {}
+    for i in range(0, len(unique_names), 20):
+        for page in paginator.paginate(
+                ResourceTypeFilters=['elasticmapreduce:cluster'],
+                TagFilters=[{'Key': 'emr_unique_name',
+                    'Values': unique_names[i:i + 20]}]):
+            for resource in page['ResourceTagMappingList']:
+                tags = dict((tag['Key'], tag['Value'])
+                        for tag in resource.get('Tags', []))
+                tagged[resource['ResourceARN'].split('/')[-1]] = \
+                        tags.get('emr_unique_name')
+    return tagged
+
+
+def terminate_clusters(session, cluster_ids, unprotect=False):
+    """Terminates clusters, TERMINATE_BATCH_SIZE clusters per API call
+
+    Args:
+        session (boto3.session): session to use
+        cluster_ids (list): clusters to terminate
+        unprotect (bool): turn termination protection off first. Protected
+            clusters are not terminated otherwise
+    """
+    emr = session.client('emr')
+    cluster_ids = list(cluster_ids)
+    for i in range(0, len(cluster_ids), TERMINATE_BATCH_SIZE):
+        batch = cluster_ids[i:i + TERMINATE_BATCH_SIZE]
+        if unprotect:
+            emr.set_termination_protection(JobFlowIds=batch,
+                    TerminationProtected=False)
+        emr.terminate_job_flows(JobFlowIds=batch)
+
+
+def add_steps(session, cluster_id, steps):
+    """Adds steps to a running cluster, respecting EMR's limits
+
+    Steps are sent STEPS_PER_CALL at a time, and never so many that the
+    cluster would have more than MAX_ACTIVE_STEPS steps pending or running.
+    If the cluster is full, waits for some of its steps to finish.
+
+    Args:
+        session (boto3.session): session to use
+        cluster_id (str): cluster to add the steps to
+        steps (list): steps, in boto3 format
+
+    Returns:
+        list of step IDs, in the same order as the steps
+    """
+    emr = session.client('emr')
+    step_ids = []
+    while len(step_ids) < len(steps):
+        room = MAX_ACTIVE_STEPS - count_active_steps(session, cluster_id)
+        if room <= 0:
+            sleep(STEPS_POLL_INTERVAL)
             continue
+        batch = steps[len(step_ids):
+                len(step_ids) + min(room, STEPS_PER_CALL)]
+        step_ids.extend(emr.add_job_flow_steps(JobFlowId=cluster_id,
+                Steps=batch)['StepIds'])
+    return step_ids
 
-    return cluster_ids
 
+def count_active_steps(session, cluster_id):
+    """Returns the number of PENDING and RUNNING steps of a cluster"""
+    emr = session.client('emr')
+    paginator = emr.get_paginator('list_steps')
+    count = 0
+    for page in paginator.paginate(ClusterId=cluster_id,
+            StepStates=['PENDING', 'RUNNING']):
+        count += len(page['Steps'])
+    return count
+
+
+def watch_cluster(session, cluster_id, step_ids=None,
+        min_interval=WATCH_MIN_INTERVAL, max_interval=WATCH_MAX_INTERVAL):
+    """Follows a cluster and its steps until there's nothing left to wait for
+
+    That is until the cluster is WAITING with no pending or running steps,
+    or until it's terminated. The steps followed are listed once at the
+    start: all of the cluster's steps, or only 'step_ids'. After
+    that, each check lists only the steps that are still active, plus the
+    final state of those that stopped being active since the last check,
+    so the number of calls doesn't grow with the number of finished steps.
+    Steps added and finished between two checks are not seen.
+
+    Checks are frequent after a change and get rarer while nothing
+    happens, see poll_interval(). They get more frequent again when the
+    cluster has been in a state for about as long as it usually takes
+    (CLUSTER_STATE_SECONDS), or the running step for about as long as
+    finished steps took, on average.
+
+    Args:
+        session (boto3.session): session to use
+        cluster_id (str): cluster to follow
+        step_ids (list): steps to follow, all steps if None. Other steps
+            are still waited for, but never yielded
+        min_interval (int): shortest time between checks, in seconds
+        max_interval (int): longest time between checks, in seconds
+
+    Yields:
+        ('cluster', cluster) when the cluster changes state, cluster being
+        what describe_cluster returns, and ('step', step) for every step
+        seen for the first time or changing state, step being what
+        list_steps returns
+    """
+    emr = session.client('emr')
+    # step id -> state
+    step_states = {}
+    # seconds finished steps took
+    durations = []
+    # start time of the running steps, as timestamps
+    running = {}
+
+    def step_changed(step):
+        state = step['Status']['State']
+        timeline = step['Status'].get('Timeline', {})
+        step_states[step['Id']] = state
+        if state == 'RUNNING' and 'StartDateTime' in timeline:
+            running[step['Id']] = timeline['StartDateTime'].timestamp()
+        else:
+            running.pop(step['Id'], None)
+        if 'StartDateTime' in timeline and 'EndDateTime' in timeline:
+            durations.append((timeline['EndDateTime']
+                - timeline['StartDateTime']).total_seconds())
+
+    paginator = emr.get_paginator('list_steps')
+    steps = []
+    if step_ids is None:
+        for page in paginator.paginate(ClusterId=cluster_id):
+            steps.extend(page['Steps'])
+    else:
+        step_ids = list(step_ids)
+        for i in range(0, len(step_ids), LIST_STEPS_MAX_IDS):
+            steps[:0] = emr.list_steps(ClusterId=cluster_id,
+                    StepIds=step_ids[i:i + LIST_STEPS_MAX_IDS])['Steps']
+    # list_steps returns the most recent first
+    for step in reversed(steps):
+        step_changed(step)
+        yield 'step', step
+
+    cluster_state = None
+    changed_at = time()
+    while True:
+        cluster = emr.describe_cluster(ClusterId=cluster_id)['Cluster']
+        if cluster['Status']['State'] != cluster_state:
+            cluster_state = cluster['Status']['State']
+            changed_at = time()
+            yield 'cluster', cluster
+
+        active = set()
+        for page in paginator.paginate(ClusterId=cluster_id,
+                StepStates=STEP_STATES_ACTIVE):
+            for step in reversed(page['Steps']):
+                active.add(step['Id'])
+                if step_ids is not None and step['Id'] not in step_states:
+                    continue
+                if step_states.get(step['Id']) != step['Status']['State']:
+                    step_changed(step)
+                    yield 'step', step
+        finished = [step_id for step_id, state in step_states.items()
+                if state in STEP_STATES_ACTIVE and step_id not in active]
+        for i in range(0, len(finished), LIST_STEPS_MAX_IDS):
+            for step in emr.list_steps(ClusterId=cluster_id,
+                    StepIds=finished[i:i + LIST_STEPS_MAX_IDS])['Steps']:
+                step_changed(step)
+                yield 'step', step
+
+        if cluster_state in CLUSTER_STATES_OFF \
+                or (cluster_state == 'WAITING' and not active):
+            return
+
+        now = time()
+        interval = poll_interval(now - changed_at,
+                CLUSTER_STATE_SECONDS.get(cluster_state),
+                min_interval, max_interval)
+        if running:
+            interval = min(interval, poll_interval(
+                now - min(running.values()),
+                sum(durations) / len(durations) if durations else None,
+                min_interval, max_interval))
+        sleep(interval)
+
+
+def poll_interval(stable_for, expected=None, min_interval=WATCH_MIN_INTERVAL,
+        max_interval=WATCH_MAX_INTERVAL):
+    """Returns how long to wait before checking something again
+
+    The longer nothing changed, the longer the wait: a quarter of the time
+    things have been stable. If it's known how long they usually stay that
+    way, the wait is never more than half of the time left, so checks get
+    more frequent as a change gets closer, and short again right after
+    the change was expected.
+
+    Args:
+        stable_for (float): seconds since the last change
+        expected (float): seconds things usually stay unchanged, if known
+
+    Returns:
+        seconds, between min_interval and max_interval
+    """
+    interval = stable_for / 4.0
+    if expected is not None and stable_for < expected:
+        interval = min(interval, (expected - stable_for) / 2.0)
+    elif expected is not None:
+        # late, back off again starting from when the change was expected
+        interval = (stable_for - expected) / 4.0
+    return max(min_interval, min(max_interval, interval))
+
+
+def list_pool_clusters(session, fingerprint):
+    """Returns the clusters of a warm pool that could be used, now or soon
+
+    Args:
+        session (boto3.session): session to use
+        fingerprint (str): value of the POOL_TAG tag
+
+    Returns:
+        list of (cluster id, state, leased) tuples, for the clusters having
+        the fingerprint that are STARTING, BOOTSTRAPPING or WAITING. 'leased'
+        is True if the cluster was claimed less than LEASE_SECONDS ago
+    """
+    emr = session.client('emr')
+    clusters = list(iter_clusters(session,
+            states=['STARTING', 'BOOTSTRAPPING', 'WAITING'],
+            tags_all={POOL_TAG: fingerprint}))
+
+    def describe(cluster):
+        return emr.describe_cluster(ClusterId=cluster['Id'])['Cluster']
+
+    pool = []
+    with ThreadPoolExecutor(max_workers=DESCRIBE_CONCURRENCY) as executor:
+        for details in executor.map(describe, clusters):
+            tags = dict((tag['Key'], tag['Value']) for tag in details['Tags'])
+            pool.append((details['Id'], details['Status']['State'],
+                    lease_is_held(tags.get(LEASE_TAG))))
+    return pool
+
+
+def lease_is_held(lease):
+    """Tells if a LEASE_TAG value is less than LEASE_SECONDS old"""
+    try:
+        return time() - float(lease.split('/')[0]) < LEASE_SECONDS
+    except (AttributeError, ValueError):
+        return False
+
+
+def new_lease():
+    """Returns a LEASE_TAG value: time, host and process making the claim"""
+    return '{:.0f}/{}/{}'.format(time(), gethostname(), getpid())
+
+
+def claim_pool_cluster(session, fingerprint):
+    """Claims an idle cluster of a warm pool
+
+    A WAITING cluster that isn't leased is claimed by tagging it with a new
+    lease. The tag is read back a moment later, if another process claimed
+    the same cluster meanwhile only the last one to write it keeps it. The
+    lease lasts LEASE_SECONDS, steps have to be sent to the cluster before
+    that, it's free again as soon as it's WAITING after that.
+
+    Args:
+        session (boto3.session): session to use
+        fingerprint (str): value of the POOL_TAG tag
+
+    Returns:
+        the ID of the claimed cluster, None if there are no idle clusters
+    """
+    for cluster_id, state, leased in list_pool_clusters(session, fingerprint):
+        if state == 'WAITING' and not leased \
+                and lease_cluster(session, cluster_id):
+            return cluster_id
+    return None
+
+
+def lease_cluster(session, cluster_id):
+    """Tags a WAITING cluster with a new lease, and reads it back
+
+    The cluster is described right before, and left alone if another
+    process holds a lease on it by then: the list of idle clusters may be
+    older than that process' lease.
+
+    Returns:
+        True if the cluster is still WAITING and the lease is still this
+        process' one after LEASE_SETTLE_SECONDS
+    """
+    emr = session.client('emr')
+    cluster = emr.describe_cluster(ClusterId=cluster_id)['Cluster']
+    tags = dict((tag['Key'], tag['Value']) for tag in cluster['Tags'])
+    if cluster['Status']['State'] != 'WAITING' \
+            or lease_is_held(tags.get(LEASE_TAG)):
+        return False
+    lease = new_lease()
+    emr.add_tags(ResourceId=cluster_id,
+            Tags=[{'Key': LEASE_TAG, 'Value': lease}])
+    sleep(LEASE_SETTLE_SECONDS)
+    cluster = emr.describe_cluster(ClusterId=cluster_id)['Cluster']
+    return cluster['Status']['State'] == 'WAITING' \
+            and tags_match(cluster['Tags'], tags_all={LEASE_TAG: lease})
+
+
+def run_step_graph(session, cluster_id, steps, depends_on,
+        keep_alive=True, min_interval=WATCH_MIN_INTERVAL,
+        max_interval=WATCH_MAX_INTERVAL):
+    """Sends steps to a cluster as soon as the steps they depend on completed
+
+    All steps that are ready are sent together, and the cluster runs as
+    many of them at the same time as its StepConcurrencyLevel allows. Then
+    the submitted steps are checked, by ID, until more steps are ready.
+    Steps depending on a step that failed, was cancelled or interrupted
+    are never sent. Checks are spaced like watch_cluster() does, see
+    poll_interval(). Returns when there's nothing left to send, without
+    waiting for the last steps to finish.
+
+    The cluster has to be kept alive when it has no steps, it would
+    terminate between two steps otherwise. If 'keep_alive' is False, that
+    is turned off once all steps were sent, so the cluster terminates after
+    the last ones.
+
+    Args:
+        session (boto3.session): session to use
+        cluster_id (str): cluster to run the steps on
+        steps (list): steps in boto3 format
+        depends_on (list): for each step, indexes in 'steps' of the steps it
+            depends on, see emrer_to_boto3.b3_step_graph()
+        keep_alive (bool): leave the cluster running when it's done
+
+    Yields:
+        ('submitted', (index, step id)) when a step is sent,
+        ('step', step) when a sent step changes state, step being what
+        list_steps returns, and ('skipped', index) for steps that won't be
+        sent because a step they depend on didn't complete
+    """
+    emr = session.client('emr')
+    step_ids = {}
+    states = {}
+    skipped = set()
+    durations = []
+    changed_at = time()
+    while True:
+        ready = [i for i in range(len(steps))
+                if i not in step_ids and i not in skipped
+                and all(states.get(p) == 'COMPLETED' for p in depends_on[i])]
+        if ready:
+            new_ids = add_steps(session, cluster_id,
+                    [steps[i] for i in ready])
+            for i, step_id in zip(ready, new_ids):
+                step_ids[i] = step_id
+                states[i] = 'PENDING'
+                yield 'submitted', (i, step_id)
+
+        # a step that can't run takes down everything that depends on it
+        found = True
+        while found:
+            found = False
+            for i in range(len(steps)):
+                if i in step_ids or i in skipped:
+                    continue
+                if any(p in skipped or states.get(p) in STEP_STATES_FAILED
+                        for p in depends_on[i]):
+                    skipped.add(i)
+                    found = True
+                    yield 'skipped', i
+
+        if len(step_ids) + len(skipped) == len(steps):
+            if not keep_alive:
+                emr.set_keep_job_flow_alive_when_no_steps(
+                        JobFlowIds=[cluster_id],
+                        KeepJobFlowAliveWhenNoSteps=False)
+            return
+        active = [i for i in step_ids if states[i] in STEP_STATES_ACTIVE]
+        if not active:
+            raise RuntimeError('Steps are waiting for steps that will never '
+                    'run: {}'.format(sorted(set(range(len(steps)))
+                        - set(step_ids) - skipped)))
+
+        sleep(poll_interval(time() - changed_at,
+            sum(durations) / len(durations) if durations else None,
+            min_interval, max_interval))
+        index_of = dict((step_ids[i], i) for i in active)
+        for j in range(0, len(active), LIST_STEPS_MAX_IDS):
+            for step in emr.list_steps(ClusterId=cluster_id,
+                    StepIds=[step_ids[i] for i in
+                        active[j:j + LIST_STEPS_MAX_IDS]])['Steps']:
+                i = index_of[step['Id']]
+                if step['Status']['State'] == states[i]:
+                    continue
+                states[i] = step['Status']['State']
+                changed_at = time()
+                timeline = step['Status'].get('Timeline', {})
+                if 'StartDateTime' in timeline and 'EndDateTime' in timeline:
+                    durations.append((timeline['EndDateTime']
+                        - timeline['StartDateTime']).total_seconds())
+                yield 'step', step
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""End to end benchmark of emrer commands, against a fake AWS
+
+Runs emrer's own command line (main()) in this process, with every AWS
+session made by fakeaws: nothing leaves the machine and no credentials are
+needed. Each scenario gets a new fake account holding --fleet-size made up
+clusters and an empty cache directory, so every run is a cold one. Requests
+take --latency seconds, and can be throttled with --throttle-rate or
+--rate-limit, botocore retries them as usual.
+
+For each scenario it reports the wall-clock time (median of --repeat runs),
+the number of API calls, the HTTP requests that were retries and how many
+of those were throttled, as counted by metricslib.
+
+Results can be saved as a baseline and later runs compared against it:
+    ./bench_e2e.py --save-baseline
+    ./bench_e2e.py --threshold 0.25
+The second one exits with 1 if a scenario got more than 25% slower, or
+makes more API calls than it used to.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import warnings
+from contextlib import redirect_stdout
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+from os import chdir, devnull, getcwd, path
+from shutil import copytree, rmtree
+from sys import argv, path as sys_path
+from tempfile import mkdtemp
+from timeit import default_timer
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys_path.insert(0, ROOT)
+
+import cachelib
+import fakeaws
+from metricslib import metrics
+
+# the emrer script has no .py extension, load it by hand
+_loader = SourceFileLoader('emrer', path.join(ROOT, 'emrer'))
+emrer = module_from_spec(spec_from_loader('emrer', _loader))
+_loader.exec_module(emrer)
+
+DEFAULT_BASELINE = path.join(path.dirname(path.abspath(__file__)),
+        'baseline_e2e.json')
+DEMO_DIR = path.join(ROOT, 'emrer_demo')
+# configurations started together by 'start-batch'
+BATCH_SIZE = 20
+# how long steps run in the fake, clusters that were started stay busy
+# for the whole run
+STEP_SECONDS = 3600
+
+# name -> (emrer arguments run first and not measured, emrer arguments,
+# fake options that differ from the command line ones). {demo} is the demo
+# configuration, {batch} the batch configurations, {graph} a configuration
+# with steps that depend on each other
+SCENARIOS = [
+    ('start', [], ['start', '{demo}'], {}),
+    ('start-batch', [], ['start', '{batch}'], {}),
+    # steps have to complete for the graph to go on
+    ('start-graph', [], ['start', '{graph}'], {'step_seconds': 0}),
+    ('list', [], ['list'], {}),
+    ('list-all', [], ['list', '-s', 'all'], {}),
+    ('list-tag', [], ['list', '-t', 'team=data'], {}),
+    ('list-fleet', [], ['list', '-p', 'one', '-p', 'two',
+        '-r', 'us-east-1', '-r', 'eu-west-1'], {}),
+    ('stop', ['start', '{demo}'], ['stop', '-f', '{demo}'], {}),
+    ('stop-tag', [], ['stop', '-f', '-t', 'team=data'], {}),
+]
+
+
+def write_batch(workdir):
+    """Copies the demo configuration and writes variants of it
+
+    Returns:
+        (path of the demo copy, list of paths of BATCH_SIZE variants, path
+        of a variant whose steps depend on each other)
+    """
+    demo_dir = path.join(workdir, 'emrer_demo')
+    copytree(DEMO_DIR, demo_dir)
+    batch = []
+    for i in range(BATCH_SIZE):
+        config = path.join(demo_dir, 'batch_{:03}.yaml'.format(i))
+        with open(config, 'w') as f:
+            f.write("extends: emrer_demo.yaml\n"
+                    "unique_name: 'benchmark_{0:03}'\n"
+                    "name: 'benchmark {0}'\n".format(i))
+        batch.append(config)
+    graph = path.join(demo_dir, 'graph.yaml')
+    with open(graph, 'w') as f:
+        f.write("extends: emrer_demo.yaml\n"
+                "unique_name: 'benchmark_graph'\n"
+                "release_label: 'emr-6.15.0'\n"
+                "steps:\n"
+                "  - {name: a, type: jar, command: /usr/bin/true a}\n"
+                "  - {name: b, type: jar, command: /usr/bin/true b}\n"
+                "  - {name: c, type: jar, command: /usr/bin/true c,\n"
+                "     depends_on: [a, b]}\n")
+    return path.join(demo_dir, 'emrer_demo.yaml'), batch, graph
+
+
+def emrer_main(arguments):
+    """Runs the emrer command line once, without output"""
+    cwd = getcwd()
+    saved_argv = list(argv)
+    argv[:] = ['emrer'] + arguments
+    try:
+        with open(devnull, 'w') as null, redirect_stdout(null), \
+                warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            emrer.main()
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError('emrer {} exited with {}'.format(
+                ' '.join(arguments), e.code))
+    finally:
+        argv[:] = saved_argv
+        chdir(cwd)
+
+
+def run_once(setup, arguments, options):
+    """Runs one scenario in a new fake account and cache directory
+
+    Returns:
+        (seconds, metrics report)
+    """
+    workdir = mkdtemp(prefix='emrer_bench_')
+    try:
+        cachelib.CACHE_DIR = path.join(workdir, 'cache')
+        demo, batch, graph = write_batch(workdir)
+
+        def expand(arguments):
+            expanded = []
+            for argument in arguments:
+                if argument == '{batch}':
+                    expanded.extend(batch)
+                else:
+                    expanded.append(argument.replace('{demo}', demo)
+                            .replace('{graph}', graph))
+            return expanded
+
+        fakeaws.install(**options)
+        metrics.enabled = True
+        if setup:
+            emrer_main(expand(setup))
+        metrics.reset()
+        start = default_timer()
+        emrer_main(expand(arguments))
+        seconds = default_timer() - start
+        return seconds, metrics.report()
+    finally:
+        fakeaws.uninstall()
+        metrics.enabled = False
+        rmtree(workdir)
+
+
+def run(scenarios, repeat, options):
+    """Runs scenarios 'repeat' times each
+
+    Returns:
+        dictionary of scenario -> {'seconds', 'calls', 'retries',
+        'throttles'}
+    """
+    results = {}
+    for name, setup, arguments, overrides in SCENARIOS:
+        if scenarios and name not in scenarios:
+            continue
+        times = []
+        for _ in range(repeat):
+            seconds, report = run_once(setup, arguments,
+                    dict(options, **overrides))
+            times.append(seconds)
+        totals = report['api_totals']
+        results[name] = {
+            'seconds': sorted(times)[len(times) // 2],
+            'calls': totals['calls'],
+            'retries': totals['retries'],
+            'throttles': totals['throttles'],
+        }
+    return results
+
+
+def main():
+    optparser = argparse.ArgumentParser(
+            description="benchmark emrer commands against a fake AWS")
+    optparser.add_argument("scenario", nargs='*',
+            help="scenarios to run, all by default: " + ', '.join(
+                name for name, _, _, _ in SCENARIOS))
+    optparser.add_argument("--repeat", type=int, default=3,
+            help="runs per scenario, the median is kept")
+    optparser.add_argument("--fleet-size", type=int, default=5000,
+            help="clusters in each fake account")
+    optparser.add_argument("--latency", type=float, default=0.01,
+            help="seconds each request takes")
+    optparser.add_argument("--throttle-rate", type=float, default=0.0,
+            help="part of the requests that are throttled")
+    optparser.add_argument("--rate-limit", type=float,
+            help="calls per second allowed for each operation")
+    optparser.add_argument("--tagging-seconds", type=float, default=60,
+            help="how long the tagging API takes to know about a cluster")
+    optparser.add_argument("--seed", type=int, default=0,
+            help="seed for the made up clusters and throttling")
+    optparser.add_argument("--baseline", default=DEFAULT_BASELINE,
+            help="baseline file")
+    optparser.add_argument("--save-baseline", action='store_true',
+            help="save the results as the new baseline")
+    optparser.add_argument("--threshold", type=float, default=0.25,
+            help="allowed regression, relative to the baseline")
+    args = optparser.parse_args()
+
+    options = {
+        'fleet_size': args.fleet_size,
+        'latency': args.latency,
+        'throttle_rate': args.throttle_rate,
+        'rate_limit': args.rate_limit,
+        'tagging_seconds': args.tagging_seconds,
+        'seed': args.seed,
+        'step_seconds': STEP_SECONDS,
+    }
+    results = run(args.scenario, args.repeat, options)
+    print('{:<16}{:>12}{:>10}{:>10}{:>10}'.format('scenario', 'ms', 'calls',
+        'retries', 'throttles'))
+    for name, _, _, _ in SCENARIOS:
+        if name in results:
+            result = results[name]
+            print('{:<16}{:>12.1f}{:>10}{:>10}{:>10}'.format(name,
+                result['seconds'] * 1000, result['calls'], result['retries'],
+                result['throttles']))
+
+    problems = []
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'options': options, 'results': results}, f, indent=2,
+                    sort_keys=True)
+        print('Baseline saved to ' + args.baseline)
+    elif path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['options'] != options:
+            print('The baseline was made with other options, not comparing: '
+                    + json.dumps(baseline['options'], sort_keys=True))
+            baseline['results'] = {}
+        for name, result in sorted(results.items()):
+            if name not in baseline['results']:
+                continue
+            expected = baseline['results'][name]
+            if result['seconds'] > expected['seconds'] * (1 + args.threshold):
+                problems.append('{} takes {:.1f}ms, baseline {:.1f}ms'.format(
+                    name, result['seconds'] * 1000,
+                    expected['seconds'] * 1000))
+            if result['calls'] > expected['calls']:
+                problems.append('{} makes {} calls, baseline {}'.format(
+                    name, result['calls'], expected['calls']))
+    else:
+        print('No baseline to compare against, use --save-baseline')
+
+    if problems:
+        print('REGRESSIONS:')
+        for problem in problems:
+            print('  ' + problem)
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
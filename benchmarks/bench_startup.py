@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Startup time benchmark for the emrer command line
+
+Runs emrer as a new process for each action and measures the time until
+its first AWS API call. All AWS endpoints point to a closed local port and
+retries are disabled, so the first call fails right away and the process
+exits: its run time is the time to the first API call, plus a traceback.
+Actions that make no API call ('--help', 'compile') simply run to the end.
+Nothing reaches AWS, the credentials are fake.
+
+Every run is done with 'python -X importtime', which also gives the
+modules each action imports. Some modules must not be imported by some
+actions, e.g. yaml by 'stop <cluster id>'. Loading them anyway is reported
+as a failure.
+
+Results can be saved as a baseline and later runs compared against it:
+    ./bench_startup.py --save-baseline
+    ./bench_startup.py --threshold 0.25
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+from os import environ, path
+from shutil import rmtree
+from subprocess import PIPE, Popen
+from sys import executable
+from tempfile import mkdtemp
+from timeit import default_timer
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+EMRER = path.join(ROOT, 'emrer')
+DEMO_CONFIG = path.join(ROOT, 'emrer_demo', 'emrer_demo.yaml')
+DEFAULT_BASELINE = path.join(path.dirname(path.abspath(__file__)),
+        'baseline_startup.json')
+
+# name -> (emrer arguments, modules that must not be imported)
+SCENARIOS = [
+    ('help', ['--help'], ['boto3', 'botocore', 'yaml']),
+    ('stop-id', ['stop', '-f', 'j-BENCHMARK000'], ['yaml', 'tarfile']),
+    ('list', ['list'], ['yaml', 'tarfile']),
+    ('compile', ['compile', DEMO_CONFIG], ['boto3', 'botocore']),
+    ('start', ['start', DEMO_CONFIG], []),
+]
+
+
+def run_once(arguments, cache_dir):
+    """Runs emrer once
+
+    Returns:
+        (seconds, set of imported module names)
+    """
+    env = dict(environ)
+    env.update({
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_CONFIG_FILE': path.join(cache_dir, 'aws_config'),
+        'AWS_SHARED_CREDENTIALS_FILE': path.join(cache_dir, 'aws_credentials'),
+        'AWS_EC2_METADATA_DISABLED': 'true',
+        # nothing listens on the discard port, calls fail immediately
+        'AWS_ENDPOINT_URL': 'http://127.0.0.1:9',
+        'AWS_MAX_ATTEMPTS': '1',
+        'AWS_RETRY_MODE': 'standard',
+        'EMRER_CACHE_DIR': cache_dir,
+    })
+    start = default_timer()
+    process = Popen([executable, '-X', 'importtime', EMRER] + arguments,
+            stdout=PIPE, stderr=PIPE, stdin=PIPE, env=env, cwd=ROOT)
+    _, err = process.communicate()
+    seconds = default_timer() - start
+
+    modules = set()
+    for line in err.decode('utf-8', 'replace').splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and '|' in line:
+            name = line.split('|')[-1].strip()
+            modules.add(name.split('.')[0])
+    return seconds, modules
+
+
+def run(repeat):
+    """Runs every scenario 'repeat' times
+
+    Returns:
+        (results, problems): results is a dictionary of scenario ->
+        {'seconds', 'modules'}, problems a list of forbidden imports
+    """
+    results = {}
+    problems = []
+    cache_dir = mkdtemp(prefix='emrer_bench_')
+    try:
+        for name, arguments, forbidden in SCENARIOS:
+            times = []
+            for _ in range(repeat):
+                seconds, modules = run_once(arguments, cache_dir)
+                times.append(seconds)
+            results[name] = {
+                'seconds': sorted(times)[len(times) // 2],
+                'modules': len(modules),
+            }
+            for module in forbidden:
+                if module in modules:
+                    problems.append('{} imports {}'.format(name, module))
+    finally:
+        rmtree(cache_dir)
+    return results, problems
+
+
+def main():
+    optparser = argparse.ArgumentParser(
+            description="benchmark emrer time to first API call")
+    optparser.add_argument("--repeat", type=int, default=5,
+            help="runs per action, the median is kept")
+    optparser.add_argument("--baseline", default=DEFAULT_BASELINE,
+            help="baseline file")
+    optparser.add_argument("--save-baseline", action='store_true',
+            help="save the results as the new baseline")
+    optparser.add_argument("--threshold", type=float, default=0.25,
+            help="allowed regression, relative to the baseline")
+    args = optparser.parse_args()
+
+    results, problems = run(args.repeat)
+    print('{:<16}{:>12}{:>12}'.format('action', 'ms', 'modules'))
+    for name, _, _ in SCENARIOS:
+        print('{:<16}{:>12.1f}{:>12}'.format(name,
+            results[name]['seconds'] * 1000, results[name]['modules']))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Baseline saved to ' + args.baseline)
+    elif path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for name, result in sorted(results.items()):
+            if name not in baseline:
+                continue
+            if result['seconds'] > \
+                    baseline[name]['seconds'] * (1 + args.threshold):
+                problems.append('{} takes {:.1f}ms, baseline {:.1f}ms'.format(
+                    name, result['seconds'] * 1000,
+                    baseline[name]['seconds'] * 1000))
+    else:
+        print('No baseline to compare against, use --save-baseline')
+
+    if problems:
+        print('REGRESSIONS:')
+        for problem in problems:
+            print('  ' + problem)
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the YAML -> boto3 translation layer
+
+Builds synthetic configurations of growing size in a temporary directory
+and times b3_step, b3_bootstrap, b3_config, b3_tags and
+get_emr_cluster_settings on them. Nothing is uploaded and no AWS call is
+made: uploads are only collected, and the session passed around refuses to
+create clients. emrer's cache directory is in the temporary directory too,
+and is not used: files are read and parsed again on each run. b3_config is
+also timed with the files already read, as b3_config_warm.
+
+For each function and size it reports the best time out of a few runs, the
+throughput in items per second and the peak memory allocated (tracemalloc).
+
+Results can be saved as a baseline and later runs compared against it:
+    ./bench_translation.py --save-baseline
+    ./bench_translation.py --threshold 0.25
+The second one exits with 1 if anything got more than 25% slower, or uses
+more than 25% more memory.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import tracemalloc
+from copy import deepcopy
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+from os import chdir, getcwd, makedirs, path
+from shutil import rmtree
+from sys import path as sys_path
+from tempfile import mkdtemp
+from timeit import default_timer
+
+import yaml
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys_path.insert(0, ROOT)
+
+import cachelib
+import configlib
+import emrer_to_boto3
+from emrer_to_boto3 import b3_tags, b3_bootstrap, b3_step, b3_config
+
+# the emrer script has no .py extension, load it by hand
+_loader = SourceFileLoader('emrer', path.join(ROOT, 'emrer'))
+emrer = module_from_spec(spec_from_loader('emrer', _loader))
+_loader.exec_module(emrer)
+
+DEFAULT_BASELINE = path.join(path.dirname(path.abspath(__file__)),
+        'baseline_translation.json')
+DEFAULT_SIZES = [10, 100, 1000]
+
+
+class StubSession(object):
+    """Stands in for boto3.session.Session, fails if anything goes to AWS"""
+    profile_name = 'benchmark'
+    region_name = 'benchmark'
+
+    def client(self, *args, **kwargs):
+        raise RuntimeError('The benchmark tried to create a client')
+
+
+def build_config(size, workdir):
+    """Writes a synthetic configuration with 'size' items of each kind
+
+    Returns:
+        dictionary, as it would be loaded from the YAML file
+    """
+    makedirs(path.join(workdir, 'bootstrap'))
+    makedirs(path.join(workdir, 'configurations'))
+    makedirs(path.join(workdir, 'steps'))
+    for i in range(size):
+        with open(path.join(workdir, 'bootstrap', 'Boot_{:05}.sh'.format(i)),
+                'w') as f:
+            f.write('#!/bin/sh\necho {}\n'.format(i))
+        with open(path.join(workdir, 'steps', 'step_{:05}.sh'.format(i)),
+                'w') as f:
+            f.write('#!/bin/sh\necho {}\n'.format(i))
+        with open(path.join(workdir, 'configurations',
+                'conf_{:05}.json'.format(i)), 'w') as f:
+            json.dump({'Classification': 'classification-{}'.format(i % 7),
+                    'Properties': dict(('property.{}.{}'.format(i, p), str(p))
+                        for p in range(10))}, f)
+
+    steps = []
+    for i in range(size):
+        kind = i % 4
+        if kind == 0:
+            steps.append({'name': 'script_{}'.format(i), 'type': 'shell',
+                'script': 'steps/step_{:05}.sh arg1 arg2'.format(i),
+                'name_on_s3': '_filename_'})
+        elif kind == 1:
+            steps.append({'name': 'hive_{}'.format(i), 'type': 'hive',
+                's3': 'bucket/hive/query_{}.q'.format(i),
+                'args': [{'input': 's3://bucket/in/{}'.format(i)},
+                    {'output': 's3://bucket/out/{}'.format(i)}]})
+        elif kind == 2:
+            steps.append({'name': 'command_{}'.format(i), 'type': 'jar',
+                'command': '/usr/bin/true {}'.format(i),
+                'on_failure': 'continue'})
+        else:
+            steps.append({'name': 'exec_{}'.format(i), 'type': 'custom_jar',
+                'exec': 's3://bucket/jars/job_{}.jar'.format(i),
+                'args': ['--n', str(i)], 'main_class': 'Main'})
+
+    return {
+        'unique_name': 'benchmark',
+        'name': 'benchmark',
+        'subnet_id': 'subnet-benchmark',
+        'master_security_groups': ['sg-benchmark'],
+        'slave_security_groups': ['sg-benchmark'],
+        'tags': [{'tag_{}'.format(i): 'value_{}'.format(i)}
+            for i in range(size)],
+        'bootstrap_s3bucket': 'bucket',
+        'bootstrap_s3prefix': 'bootstrap/',
+        'bootstrap_actions': [{'dir': 'bootstrap', 'args': ['a']}],
+        'configurations': [{'dir': 'configurations'}],
+        'steps_s3bucket': 'bucket',
+        'steps_s3prefix': 'steps/',
+        'steps': steps + [{'name': 'dir', 'type': 'shell', 'dir': 'steps'}],
+    }
+
+
+def forget_files():
+    """Empties the in-memory caches of parsed files, for a cold run"""
+    emrer_to_boto3._fragments.clear()
+    configlib._parsed.clear()
+
+
+def benchmarks(cset, config_file):
+    """Returns (name, items, function, setup) for each thing to be measured
+
+    'setup' is called before each run of 'function', untimed, if not None.
+    """
+    session = StubSession()
+
+    def steps():
+        uploads = []
+        for step in deepcopy(cset['steps']):
+            b3_step(step, 'bucket', 'steps/', session, uploads=uploads)
+
+    def bootstrap():
+        uploads = []
+        for action in cset['bootstrap_actions']:
+            b3_bootstrap(action, 'bucket', 'bootstrap/', session,
+                    uploads=uploads)
+
+    def config():
+        for configuration in cset['configurations']:
+            b3_config(configuration)
+
+    def tags():
+        b3_tags(cset['tags'])
+
+    def settings():
+        emrer.get_emr_cluster_settings(config_file, use_cache=False)
+
+    size = len(cset['tags'])
+    return [
+        ('b3_step', 2 * size, steps, None),
+        ('b3_bootstrap', size, bootstrap, None),
+        ('b3_config', size, config, forget_files),
+        ('b3_config_warm', size, config, None),
+        ('b3_tags', size, tags, None),
+        ('get_emr_cluster_settings', size, settings, forget_files),
+    ]
+
+
+def measure(function, repeat, setup=None):
+    """Returns (best time in seconds, peak memory in bytes)"""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = default_timer()
+        function()
+        times.append(default_timer() - start)
+    # memory is measured on a separate run, tracemalloc slows things down
+    if setup:
+        setup()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def run(sizes, repeat):
+    """Runs all benchmarks for all sizes
+
+    Returns:
+        dictionary of 'function/size' -> {'seconds', 'per_second', 'peak'}
+    """
+    results = {}
+    cwd = getcwd()
+    cache_dir = cachelib.CACHE_DIR
+    for size in sizes:
+        workdir = mkdtemp(prefix='emrer_bench_')
+        try:
+            chdir(workdir)
+            cachelib.CACHE_DIR = path.join(workdir, 'cache')
+            cset = build_config(size, workdir)
+            with open('config.yaml', 'w') as f:
+                yaml.safe_dump(cset, f)
+            for name, items, function, setup in benchmarks(cset,
+                    'config.yaml'):
+                seconds, peak = measure(function, repeat, setup)
+                results['{}/{}'.format(name, size)] = {
+                    'seconds': seconds,
+                    'per_second': items / seconds if seconds else 0,
+                    'peak': peak,
+                }
+        finally:
+            chdir(cwd)
+            cachelib.CACHE_DIR = cache_dir
+            rmtree(workdir)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns the list of results worse than the baseline by 'threshold'"""
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for metric in ['seconds', 'peak']:
+            if result[metric] > baseline[key][metric] * (1 + threshold):
+                regressions.append('{} {}: {:.6g} -> {:.6g}'.format(key,
+                    metric, baseline[key][metric], result[metric]))
+    return regressions
+
+
+def main():
+    optparser = argparse.ArgumentParser(
+            description="benchmark the YAML to boto3 translation")
+    optparser.add_argument("--sizes", type=int, nargs='+',
+            default=DEFAULT_SIZES,
+            help="number of steps, scripts, configurations and tags")
+    optparser.add_argument("--repeat", type=int, default=5,
+            help="runs per benchmark, the best one is kept")
+    optparser.add_argument("--baseline", default=DEFAULT_BASELINE,
+            help="baseline file")
+    optparser.add_argument("--save-baseline", action='store_true',
+            help="save the results as the new baseline")
+    optparser.add_argument("--threshold", type=float, default=0.25,
+            help="allowed regression, relative to the baseline")
+    args = optparser.parse_args()
+
+    results = run(args.sizes, args.repeat)
+    print('{:<32}{:>12}{:>14}{:>12}'.format(
+        'benchmark', 'ms', 'items/s', 'peak KiB'))
+    for key, result in sorted(results.items(),
+            key=lambda item: (item[0].split('/')[0],
+                int(item[0].split('/')[1]))):
+        print('{:<32}{:>12.3f}{:>14.0f}{:>12.1f}'.format(key,
+            result['seconds'] * 1000, result['per_second'],
+            result['peak'] / 1024.0))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Baseline saved to ' + args.baseline)
+        return
+
+    if not path.isfile(args.baseline):
+        print('No baseline to compare against, use --save-baseline')
+        return
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    if regressions:
+        print('REGRESSIONS:')
+        for regression in regressions:
+            print('  ' + regression)
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+from __future__ import unicode_literals
+
+import hashlib
+import json
+from os import environ, listdir, makedirs, path, remove, rename, stat
+
+# everything emrer keeps between runs lives in this directory
+CACHE_DIR = environ.get('EMRER_CACHE_DIR',
+        path.join(path.expanduser('~'), '.cache', 'emrer'))
+
+
+def cache_path(name):
+    """
+    Returns the full path of a file in the cache directory, creating the
+    directory if it doesn't exist yet.
+    """
+    if not path.isdir(CACHE_DIR):
+        makedirs(CACHE_DIR)
+    return path.join(CACHE_DIR, name)
+
+
+def load_json(name, default=None):
+    """
+    Loads a JSON file from the cache directory. A missing or unreadable file
+    is not an error, the cache is simply empty in that case.
+
+    Args:
+        name (str): file name, relative to the cache directory
+        default: returned if the file can't be loaded
+
+    Returns:
+        whatever was stored in the file, or 'default'
+    """
+    try:
+        with open(cache_path(name), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def save_json(name, data):
+    """
+    Saves data as JSON in the cache directory. The file is written to a
+    temporary name first, then renamed, so that other emrer processes never
+    read half a file.
+    """
+    from tempfile import NamedTemporaryFile
+    file_path = cache_path(name)
+    with NamedTemporaryFile('w', dir=CACHE_DIR, delete=False) as f:
+        json.dump(data, f, sort_keys=True)
+    try:
+        rename(f.name, file_path)
+    except OSError:
+        # windows won't rename over an existing file
+        remove(file_path)
+        rename(f.name, file_path)
+
+
+def file_md5(file_path, manifest=None):
+    """
+    Returns the MD5 hex digest of a file. If a manifest is given, the digest
+    is taken from there as long as the file's mtime and size didn't change,
+    otherwise the file is read and the manifest updated.
+
+    Args:
+        file_path (str): file to hash
+        manifest (dict): path -> {'mtime', 'size', 'md5'}
+
+    Returns:
+        hex digest, as a string
+    """
+    file_path = path.abspath(file_path)
+    file_stat = stat(file_path)
+    if manifest is not None:
+        entry = manifest.get(file_path)
+        if entry and entry['mtime'] == file_stat.st_mtime \
+                and entry['size'] == file_stat.st_size:
+            return entry['md5']
+
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    digest = md5.hexdigest()
+
+    if manifest is not None:
+        manifest[file_path] = {
+                'mtime': file_stat.st_mtime,
+                'size': file_stat.st_size,
+                'md5': digest
+        }
+    return digest
+
+
+def inputs_digest(files, dirs=(), manifest=None):
+    """
+    Returns one digest covering the content of a number of files and the
+    list of files in a number of directories, so that adding a file to a
+    directory changes the digest too.
+
+    Args:
+        files (list): paths of files
+        dirs (list): paths of directories
+        manifest (dict): see file_md5()
+
+    Returns:
+        hex digest, as a string. OSError is raised if a file or directory
+        doesn't exist anymore
+    """
+    digest = hashlib.sha256()
+    for file_path in sorted(set(path.abspath(f) for f in files)):
+        digest.update('{}\0{}\0'.format(file_path,
+                file_md5(file_path, manifest)).encode('utf-8'))
+    for dir_path in sorted(set(path.abspath(d) for d in dirs)):
+        digest.update('{}\0{}\0'.format(dir_path,
+                '\0'.join(sorted(listdir(dir_path)))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def name_digest(name):
+    """Returns a short digest of a string, fit to be used in file names"""
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()
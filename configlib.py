@@ -0,0 +1,159 @@
+from __future__ import unicode_literals
+
+import json
+from os import path, stat
+from threading import Lock
+
+from cachelib import load_json, save_json, inputs_digest, name_digest
+
+# bumped when the structure of the cached configurations changes
+CONFIG_FORMAT = 1
+
+# parsed YAML files, by path, kept for the whole run: (mtime, size, data)
+_parsed = {}
+_parsed_lock = Lock()
+
+
+def yaml_loader():
+    """Returns the fastest safe YAML loader available
+
+    The C loader is used when PyYAML was built with libyaml, it's many
+    times faster than the pure Python one. yaml is imported here, and not
+    when the module is loaded, commands that don't read YAML don't need it.
+    """
+    import yaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load_yaml(file_path):
+    """
+    Parses a YAML file. The result is kept in memory for as long as the
+    file doesn't change, so a file shared by many configurations is only
+    parsed once per run. Callers must not modify what is returned.
+
+    Args:
+        file_path (str): the YAML file
+
+    Returns:
+        whatever the file contains
+    """
+    file_path = path.abspath(file_path)
+    file_stat = stat(file_path)
+    key = (file_stat.st_mtime, file_stat.st_size)
+    cached = _parsed.get(file_path)
+    if cached and cached[0] == key:
+        return cached[1]
+    from yaml import load as yaml_load
+    with open(file_path, 'r') as yaml_stream:
+        data = yaml_load(yaml_stream, Loader=yaml_loader())
+    with _parsed_lock:
+        _parsed[file_path] = (key, data)
+    return data
+
+
+def merge_settings(base, override):
+    """
+    Merges two configurations. Dictionaries are merged recursively, any
+    other value from 'override' replaces the one in 'base', lists included.
+    Neither argument is modified.
+
+    Returns:
+        the merged dictionary
+    """
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_settings(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def resolve_config(yaml_file, files=None, _stack=()):
+    """
+    Loads a configuration file and the templates it extends.
+
+    'extends' is a file name or a list of file names, relative to the
+    directory of the file that extends them. Templates can extend other
+    templates. Settings are merged in order, see merge_settings(): later
+    templates override earlier ones and the file itself overrides them all.
+    A file that contains a list is read as its first element.
+
+    Args:
+        yaml_file (str): the configuration file
+        files (list): paths of all files that were read are appended to it
+
+    Returns:
+        the resolved configuration, without 'extends'
+    """
+    file_path = path.abspath(yaml_file)
+    if file_path in _stack:
+        raise RuntimeError('Configuration files extend each other: '
+                + ' -> '.join(_stack + (file_path,)))
+    if files is not None:
+        files.append(file_path)
+
+    config = load_yaml(file_path)
+    if isinstance(config, list):
+        config = config[0]
+    if not isinstance(config, dict):
+        raise RuntimeError('{} does not contain a configuration'.format(
+            yaml_file))
+
+    extends = config.get('extends', [])
+    if not isinstance(extends, list):
+        extends = [extends]
+    resolved = {}
+    for template in extends:
+        template = path.join(path.dirname(file_path), template)
+        resolved = merge_settings(resolved, resolve_config(template, files,
+            _stack + (file_path,)))
+    resolved = merge_settings(resolved, config)
+    resolved.pop('extends', None)
+    return resolved
+
+
+def load_config(yaml_file, files=None, use_cache=True):
+    """
+    Returns a resolved configuration, see resolve_config(). The result is
+    cached under ~/.cache/emrer together with the list of files it was
+    built from, and loaded from there as long as none of those files
+    changed. Checking that costs a stat() per file, nothing is parsed.
+
+    Args:
+        yaml_file (str): the configuration file
+        files (list): paths of all files the configuration is built from
+            are appended to it
+        use_cache (bool): if False, always read the files
+
+    Returns:
+        the resolved configuration, a dictionary
+    """
+    file_path = path.abspath(yaml_file)
+    cache_name = 'config-{}.json'.format(name_digest(file_path))
+    cached = load_json(cache_name) if use_cache else None
+    if cached and cached.get('format') == CONFIG_FORMAT:
+        try:
+            digest = inputs_digest(cached['files'], (), cached['manifest'])
+        except OSError:
+            digest = None
+        if digest == cached['digest']:
+            if files is not None:
+                files.extend(cached['files'])
+            return cached['config']
+
+    read = []
+    config = resolve_config(file_path, read)
+    manifest = {}
+    # json can't store everything yaml can read, dates for example
+    config = json.loads(json.dumps(config, default=str))
+    save_json(cache_name, {
+        'format': CONFIG_FORMAT,
+        'digest': inputs_digest(read, (), manifest),
+        'files': sorted(set(read)),
+        'manifest': manifest,
+        'config': config,
+    })
+    if files is not None:
+        files.extend(read)
+    return config
@@ -3,19 +3,155 @@ from __future__ import print_function
 
 from warnings import warn
 
+import hashlib
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from shlex import split as sh_split
+from shlex import quote as sh_quote
+from os import getpid
 from os import listdir
 from os import path
+from os import rename
+from os import stat
+from threading import Lock
 
-import boto3
-from boto3.s3.transfer import S3Transfer
+from awslib import upload_to_s3_rand, s3_rand_key
+from cachelib import cache_path, file_md5
+from configlib import load_yaml
 
-from awslib import upload_to_s3_rand
+# how many configuration files are read at the same time
+FRAGMENT_CONCURRENCY = 8
+
+# parsed configuration files, by path, kept for the whole run: (mtime, size,
+# list of configurations)
+_fragments = {}
+_fragments_lock = Lock()
 
 def main():
     return
 
 
+def s3_upload(script, s3bucket, s3prefix, name_on_s3, session=None,
+        uploads=None):
+    """Uploads a local script to S3, or queues it to be uploaded later
+
+    The S3 key is built from s3prefix and name_on_s3, see the 'name_on_s3'
+    option in emrer_example.yaml for the values it can take.
+    If an 'uploads' list is received nothing is uploaded. Instead, a
+    (file, bucket, key) tuple is appended to the list, so that the caller
+    can upload everything in one go using awslib.upload_files_to_s3()
+
+    Args:
+        script (string): path to the local file
+        s3bucket (string): bucket to upload to
+        s3prefix (string): 'directory' in the bucket
+        name_on_s3 (string): name of the object, or one of the special values
+        session (boto3.session): session used for immediate uploads
+        uploads (list): if given, the upload is appended here instead
+
+    Returns:
+        the S3 path of the script, including 's3://'
+    """
+    if name_on_s3.lower() == '_random_':
+        s3key = s3_rand_key(s3prefix)
+    elif name_on_s3.lower() in [
+            '_script_', '_scriptname_', '_file_', '_filename_'
+            ]:
+        s3key = (s3prefix or '') + path.basename(script)
+    else:
+        s3key = (s3prefix or '') + name_on_s3
+
+    if uploads is None:
+        s3_path = upload_to_s3_rand(session, script, s3bucket, s3key,
+                rand_length=0)
+    else:
+        uploads.append((path.abspath(script), s3bucket, s3key))
+        s3_path = '{}/{}'.format(s3bucket, s3key)
+
+    if not 's3://' in s3_path:
+        s3_path = '{}{}'.format('s3://', s3_path)
+    return s3_path
+
+
+def dir_scripts(directory):
+    """Returns the names of the files in a directory, in execution order
+
+    Hidden files and subdirectories are skipped. The files are sorted
+    alphabetically, case insensitive.
+    """
+    return [entry for entry in sorted(listdir(directory),
+            key=lambda s: s.lower())
+        if path.isfile(path.join(directory, entry)) and entry[0] != '.']
+
+
+def bundle_dir(directory):
+    """Packs the scripts in a directory into a .tar.gz archive
+
+    The archive is built deterministically: same file names, content and
+    order give the same bytes, whatever the time, owner or permissions of
+    the files. Its name contains a digest of the content, so that it can be
+    recognized by the upload cache. Archives are built in the cache
+    directory and only if they don't exist already. Files are streamed
+    into the archive, they're never loaded in memory.
+
+    Args:
+        directory (string): directory containing the scripts
+
+    Returns:
+        (archive path, list of file names in execution order) tuple
+    """
+    entries = dir_scripts(directory)
+    digest = hashlib.sha256()
+    for entry in entries:
+        digest.update('{}\0{}\0'.format(entry,
+                file_md5(path.join(directory, entry))).encode('utf-8'))
+    bundle_name = '{}-{}.tar.gz'.format(
+            path.basename(path.normpath(path.abspath(directory))),
+            digest.hexdigest()[:16])
+    bundle_path = cache_path(bundle_name)
+    if path.isfile(bundle_path):
+        return bundle_path, entries
+
+    # only needed here, not worth loading on every run
+    import tarfile
+    from gzip import GzipFile
+
+    temp_path = '{}.{}.tmp'.format(bundle_path, getpid())
+    with open(temp_path, 'wb') as f:
+        with GzipFile(filename='', mode='wb', fileobj=f, mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode='w',
+                    format=tarfile.PAX_FORMAT) as tar:
+                for entry in entries:
+                    info = tar.gettarinfo(path.join(directory, entry), entry)
+                    info.mtime = 0
+                    info.mode = 0o755
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ''
+                    with open(path.join(directory, entry), 'rb') as script:
+                        tar.addfile(info, script)
+    rename(temp_path, bundle_path)
+    return bundle_path, entries
+
+
+def bundle_script(s3_path, entries):
+    """Returns a bash script that downloads a bundle and runs its scripts
+
+    The script is meant to be run with 'bash -c <script> <name> [args]', the
+    arguments are passed to every script in the bundle. It stops at the
+    first script that fails.
+    """
+    lines = [
+        'set -e',
+        'bundle=$(mktemp -d)',
+        'aws s3 cp {} "$bundle/bundle.tar.gz"'.format(sh_quote(s3_path)),
+        'tar -xzf "$bundle/bundle.tar.gz" -C "$bundle"',
+    ]
+    for entry in entries:
+        lines.append('"$bundle"/{} "$@"'.format(sh_quote(entry)))
+    return '\n'.join(lines)
+
+
 def b3_tags(tags_in):
     """Converts tags to boto3 format
 
@@ -40,7 +176,8 @@ def b3_tags(tags_in):
     return tags_out
 
 
-def b3_bootstrap(bootstrap_action, s3bucket=None, s3prefix=None, session=None):
+def b3_bootstrap(bootstrap_action, s3bucket=None, s3prefix=None, session=None,
+        uploads=None):
     """Converts to boto3 BootstrapAction format
 
     Receives a bootstrap action as loaded from the configuration file and
@@ -62,6 +199,10 @@ def b3_bootstrap(bootstrap_action, s3bucket=None, s3prefix=None, session=None):
         the 'dir' key replaced with a 'script' key. The files will be ordered
         alphabetically, case insensitive. Arguments will be passed to every 
         script, if defined.
+    bundle: boolean, for 'dir' only
+        Instead of one upload and one action per file, pack the directory
+        in one archive, upload it, and add a single action that unpacks it
+        and runs the scripts in the same order. See bundle_dir()
     s3: string
         Path to script on S3. 's3://' will be added if it's not there.
     command: string
@@ -75,6 +216,8 @@ def b3_bootstrap(bootstrap_action, s3bucket=None, s3prefix=None, session=None):
             be uploaded to S3. Can be overwritten for each action
         session (boto3.session): session to be used for s3 uploads,
             where needed
+        uploads (list): if given, files are not uploaded, they are added to
+            this list instead. See s3_upload()
 
     Returns:
         list element(s) to be added to the list of bootstrap actions
@@ -116,26 +259,8 @@ def b3_bootstrap(bootstrap_action, s3bucket=None, s3prefix=None, session=None):
             raise KeyError('Bucket undefined for script ' + script)
 
         name_on_s3 = bootstrap_action.get('name_on_s3', '_filename_')
-        if name_on_s3.lower() == '_random_':
-            action_path = upload_to_s3_rand(session, script,
-                    s3bucket, s3prefix)
-        elif name_on_s3.lower() in [
-                '_script_', '_scriptname_', '_file_', '_filename_'
-                ]:
-            # TODO: this is a hack to avoid writing another upload function\
-            # or changing the current one. fix this hack
-            s3prefix = s3prefix + path.basename(script)
-            action_path = upload_to_s3_rand(session, script,
-                    s3bucket, s3prefix, rand_length=0)
-        else:
-            # TODO: this is a hack to avoid writing another upload function\
-            # or changing the current one. fix this hack
-            s3prefix = s3prefix + name_on_s3
-            action_path = upload_to_s3_rand(session, script,
-                    s3bucket, s3prefix, rand_length=0)
-
-        if not 's3://' in action_path:
-            action_path = '{}{}'.format('s3://', action_path)
+        action_path = s3_upload(script, s3bucket, s3prefix, name_on_s3,
+                session=session, uploads=uploads)
 
         if 'args' in bootstrap_action:
             if isinstance(bootstrap_action['args'], str):
@@ -182,16 +307,35 @@ def b3_bootstrap(bootstrap_action, s3bucket=None, s3prefix=None, session=None):
             # directory not defined, ignore this action
             warn('"dir" type action has no directory set. Ignoring it')
             return []
-        for entry in sorted(listdir(bootstrap_action['dir']), 
-                            key=lambda s: s.lower()):
-            if not path.isfile(path.join(bootstrap_action['dir'], entry)) \
-                    or entry[0] == '.':
-                continue
+        if bootstrap_action.get('bundle'):
+            # one archive with all scripts, unpacked and run by one action
+            if not s3bucket:
+                raise KeyError('Bucket undefined for bundle '
+                        + bootstrap_action['dir'])
+            action_args = bootstrap_action.get('args', [])
+            if isinstance(action_args, str):
+                action_args = sh_split(action_args)
+            action_name = bootstrap_action.get('name',
+                    bootstrap_action['dir'].replace(' ', '_'))
+            bundle_path, entries = bundle_dir(bootstrap_action['dir'])
+            s3_path = s3_upload(bundle_path, s3bucket, s3prefix, '_filename_',
+                    session=session, uploads=uploads)
+            return [
+                {
+                    'Name': action_name,
+                    'ScriptBootstrapAction': {
+                        'Path': 'file:///bin/bash',
+                        'Args': ['-c', bundle_script(s3_path, entries),
+                            action_name] + list(action_args)
+                    }
+                }
+            ]
+        for entry in dir_scripts(bootstrap_action['dir']):
             script_action = dict(bootstrap_action)
             del script_action['dir']
             script_action['script'] = path.join(bootstrap_action['dir'], entry)
             action = b3_bootstrap(script_action, 
-                    s3bucket, s3prefix, session=session)
+                    s3bucket, s3prefix, session=session, uploads=uploads)
             actions = actions + action
     elif 's3' in bootstrap_action:
         actions = []
@@ -245,7 +389,8 @@ def b3_bootstrap(bootstrap_action, s3bucket=None, s3prefix=None, session=None):
     return actions
  
 
-def b3_step(yaml_step, s3bucket=None, s3prefix=None, session=None):
+def b3_step(yaml_step, s3bucket=None, s3prefix=None, session=None,
+        uploads=None):
     """Converts step to boto3 structure.
 
     Converts an EMR 'step' from the simplified yaml format to the syntax
@@ -289,6 +434,10 @@ def b3_step(yaml_step, s3bucket=None, s3prefix=None, session=None):
         steps. For each file the function will call itself with 'dir'
         replaced with 'script'. The files will be ordered alphabetically, 
         case insensitive. Arguments will be passed to every script, if defined.
+    bundle: boolean, for 'dir' only
+        Instead of one upload and one step per file, pack the directory in
+        one archive, upload it, and add a single step that unpacks it and
+        runs the scripts in the same order. Only for 'shell' steps
     s3: string
         Path to script on S3. 's3://' will be added if it's not there.
     command: string
@@ -312,6 +461,8 @@ def b3_step(yaml_step, s3bucket=None, s3prefix=None, session=None):
             if they are local scripts
         s3prefix (string): 'directory' in the bucket
         session (session): an already defined session object for uploading
+        uploads (list): if given, files are not uploaded, they are added to
+            this list instead. See s3_upload()
 
     Returns:
         a list element that can be added to the list of steps the cluster should
@@ -352,7 +503,8 @@ def b3_step(yaml_step, s3bucket=None, s3prefix=None, session=None):
             s3prefix = yaml_step['s3prefix']
         if not s3bucket:
             # script defined, but we don't know where to upload it
-            raise KeyError('Bucket undefined for step script ' + script)
+            raise KeyError('Bucket undefined for step script '
+                    + yaml_step['script'])
         # split 'script' in file and arguments, in case there are any
         script_line = sh_split(yaml_step['script'])
         if len(script_line) == 0:
@@ -364,25 +516,8 @@ def b3_step(yaml_step, s3bucket=None, s3prefix=None, session=None):
             yaml_step['args'] = script_line[1:] + yaml_step.get('args', [])
         # upload to s3
         name_on_s3 = yaml_step.get('name_on_s3', '_random_')
-        if name_on_s3.lower() == '_random_':
-            step_path = upload_to_s3_rand(session, script,
-                    s3bucket, s3prefix)
-        elif name_on_s3.lower() in [
-                '_script_', '_scriptname_', '_file_', '_filename_'
-                ]:
-            # TODO: this is a hack to avoid writing another upload function\
-            # or changing the current one. fix this hack
-            s3prefix = s3prefix + path.basename(script)
-            step_path = upload_to_s3_rand(session, script,
-                    s3bucket, s3prefix, rand_length=0)
-        else:
-            # TODO: this is a hack to avoid writing another upload function\
-            # or changing the current one. fix this hack
-            s3prefix = s3prefix + name_on_s3
-            step_path = upload_to_s3_rand(session, script,
-                    s3bucket, s3prefix, rand_length=0)
-        if not 's3://' in step_path:
-            step_path = '{}{}'.format('s3://', step_path)
+        step_path = s3_upload(script, s3bucket, s3prefix, name_on_s3,
+                session=session, uploads=uploads)
         # set 'exec' to the new path
         yaml_step['exec'] = step_path
     elif 'dir' in yaml_step:
@@ -392,16 +527,37 @@ def b3_step(yaml_step, s3bucket=None, s3prefix=None, session=None):
             # directory not defined, ignore this action
             warn('"dir" type step has no directory set. Ignoring it')
             return []
+        if yaml_step.get('bundle'):
+            # one archive with all scripts, unpacked and run by one step.
+            # the step is turned into a command-runner.jar one, then
+            # handled as any other jar step below
+            if yaml_step['type'].lower() not in ['shell', 'shellscript', 'sh']:
+                raise NotImplementedError('Only shell steps can be bundled, '
+                        'step {} is {}'.format(yaml_step['name'],
+                            yaml_step['type']))
+            if 's3bucket' in yaml_step:
+                s3bucket = yaml_step['s3bucket']
+            if 's3prefix' in yaml_step:
+                s3prefix = yaml_step['s3prefix']
+            if not s3bucket:
+                raise KeyError('Bucket undefined for bundle '
+                        + yaml_step['dir'])
+            bundle_path, entries = bundle_dir(yaml_step['dir'])
+            s3_path = s3_upload(bundle_path, s3bucket, s3prefix, '_filename_',
+                    session=session, uploads=uploads)
+            yaml_step = dict(yaml_step)
+            yaml_step['type'] = 'custom_jar'
+            yaml_step['exec'] = 'command-runner.jar'
+            yaml_step['args'] = ['bash', '-c', bundle_script(s3_path, entries),
+                    yaml_step['name']] + yaml_step.get('args', [])
+            return b3_step(yaml_step)
         boto_steps = []
-        for entry in sorted(listdir(yaml_step['dir']), key=lambda s: s.lower()):
-            if not path.isfile(path.join(yaml_step['dir'], entry)) \
-                    or entry[0] == '.':
-                continue
+        for entry in dir_scripts(yaml_step['dir']):
             script_step = dict(yaml_step)
             del script_step['dir']
             script_step['script'] = path.join(yaml_step['dir'], entry)
             boto_step = b3_step(script_step, 
-                    s3bucket, s3prefix, session=session)
+                    s3bucket, s3prefix, session=session, uploads=uploads)
             boto_steps.extend(boto_step)
         return boto_steps
     elif 's3' in yaml_step:
@@ -473,7 +629,6 @@ def b3_step(yaml_step, s3bucket=None, s3prefix=None, session=None):
         raise NotImplementedError(step_type)
     elif step_type in ['hive', 'hive-script', 'hive_script']:
         jar = 'command-runner.jar'
-        print(yaml_step['exec'])
         args = [
                 'hive-script', '--run-hive-script', '--args',
                 '-f', yaml_step['exec']
@@ -515,6 +670,145 @@ def b3_step(yaml_step, s3bucket=None, s3prefix=None, session=None):
     return [boto_step] # list
 
 
+def b3_step_graph(yaml_steps, s3bucket=None, s3prefix=None, session=None,
+        uploads=None):
+    """Converts steps that depend on each other to boto3 structures
+
+    Steps can name the steps they need to wait for in 'depends_on', a step
+    name or a list of them. Steps without 'depends_on' don't wait for
+    anything. A 'dir' step becomes one step per script, as usual, and those
+    still run one after the other: each depends on the one before it.
+    Depending on a 'dir' step means depending on all of its scripts.
+
+    Args:
+        yaml_steps (list): steps as read from the yaml file
+        s3bucket, s3prefix, session, uploads: see b3_step()
+
+    Returns:
+        (steps, depends_on): steps in boto3 format and, for each of them, the
+        sorted list of indexes in 'steps' of the steps it depends on.
+        KeyError is raised for unknown or ambiguous step names, RuntimeError
+        if steps depend on each other in a loop
+    """
+    steps = []
+    depends_on = []
+    # yaml step name -> indexes of the boto3 steps it became
+    indexes = {}
+    names = [yaml_step.get('name') for yaml_step in yaml_steps]
+    for yaml_step in yaml_steps:
+        prerequisites = yaml_step.get('depends_on', [])
+        if not isinstance(prerequisites, list):
+            prerequisites = [prerequisites]
+        # the step itself can't be in the list yet, steps are translated
+        # in order. dependencies on later steps are resolved below
+        generated = b3_step(dict((key, value) for key, value in
+                yaml_step.items() if key != 'depends_on'),
+                s3bucket, s3prefix, session, uploads=uploads)
+        first = len(steps)
+        for i, step in enumerate(generated):
+            steps.append(step)
+            # scripts from a dir run in order
+            depends_on.append(prerequisites if i == 0 else [first + i - 1])
+        indexes[yaml_step['name']] = list(range(first, len(steps)))
+
+    for i, prerequisites in enumerate(depends_on):
+        resolved = set()
+        for prerequisite in prerequisites:
+            if isinstance(prerequisite, int):
+                resolved.add(prerequisite)
+            elif prerequisite not in indexes:
+                raise KeyError('Step {} depends on unknown step {}'.format(
+                    steps[i]['Name'], prerequisite))
+            elif names.count(prerequisite) > 1:
+                raise KeyError('More than one step is named {}'.format(
+                    prerequisite))
+            else:
+                resolved.update(indexes[prerequisite])
+        depends_on[i] = sorted(resolved)
+
+    step_waves(depends_on, [step['Name'] for step in steps])
+    return steps, depends_on
+
+
+def step_waves(depends_on, names=None):
+    """Groups steps in waves that can run at the same time
+
+    Steps in the first wave depend on nothing, steps in each of the next
+    waves depend only on steps in earlier waves.
+
+    Args:
+        depends_on (list): for each step, the indexes of its prerequisites,
+            as returned by b3_step_graph()
+        names (list): step names, used in error messages
+
+    Returns:
+        list of waves, each a list of step indexes. RuntimeError is raised
+        if steps depend on each other in a loop
+    """
+    waiting = dict((i, set(prerequisites))
+            for i, prerequisites in enumerate(depends_on))
+    waves = []
+    done = set()
+    while waiting:
+        wave = sorted(i for i, prerequisites in waiting.items()
+                if prerequisites <= done)
+        if not wave:
+            raise RuntimeError('Steps depend on each other in a loop: '
+                    '{}'.format(', '.join(str(names[i] if names else i)
+                        for i in sorted(waiting))))
+        for i in wave:
+            del waiting[i]
+        done.update(wave)
+        waves.append(wave)
+    return waves
+
+
+def load_fragment(file_path):
+    """
+    Reads a file with one or more configurations. Files ending in .yaml or
+    .yml are parsed as YAML, anything else as JSON. The result is kept for
+    the whole run and reused for as long as the file doesn't change, so
+    files shared by many clusters are only read once. Callers must not
+    modify what is returned.
+
+    Args:
+        file_path (str): configuration file
+
+    Returns:
+        list of configurations
+    """
+    configs = cached_fragment(file_path)
+    if configs is not None:
+        return configs
+
+    file_path = path.abspath(file_path)
+    file_stat = stat(file_path)
+    if file_path.lower().endswith(('.yaml', '.yml')):
+        cfg = load_yaml(file_path)
+    else:
+        with open(file_path, 'r') as f:
+            cfg = json.load(f)
+    # could check that cfg is either a list or a dictionary here, but we'll
+    # just let boto3 deal with it, hoping it does it better than us
+    configs = cfg if isinstance(cfg, list) else [cfg]
+    with _fragments_lock:
+        _fragments[file_path] = (file_stat.st_mtime, file_stat.st_size,
+                configs)
+    return configs
+
+
+def cached_fragment(file_path):
+    """Returns what load_fragment() read from a file, None if the file
+    wasn't read yet or changed since"""
+    file_path = path.abspath(file_path)
+    cached = _fragments.get(file_path)
+    if cached:
+        file_stat = stat(file_path)
+        if cached[:2] == (file_stat.st_mtime, file_stat.st_size):
+            return cached[2]
+    return None
+
+
 def b3_config(config):
     """Convert configuration to boto3
     Convert a configuration element to JSON format to be passed to boto3. The
@@ -525,11 +819,11 @@ def b3_config(config):
     specified directly in the config file in YAML
     - file: string
         configuration will be loaded from the specified file and added to the
-        current list. File format has to be JSON. Maybe we can automatically
-        detect the format later and convert to JSON if needed.
+        current list. The file can be JSON or, if its name ends in .yaml or
+        .yml, YAML. See load_fragment()
     - dir: string
-        directory containing configuration files. The function will call
-        itself for each file in the directory, executing the case for 'file'
+        directory containing configuration files. All files in the directory
+        are read, several at the same time, and added in file name order
     - anything else: yaml
         the list element will be converted to JSON and passed to boto3 as-is
 
@@ -539,29 +833,32 @@ def b3_config(config):
     Returns:
         list of configurations in JSON format
     """
-    from json import load as json_load
-
     # TODO: check that we're getting a dictionary. MAYBE, if we're getting a
     # list we could recursively call this function
     configs = []
     if 'file' in config:
-        with open(config['file'], 'r') as f:
-           cfg = json_load(f)
-        # could check that cfg is either a list or a dictionary here, but we'll
-        # just let boto3 deal with it, hoping it does it better than us
-        if isinstance(cfg, list):
-            configs.extend(cfg)
-        else:
-            configs.append(cfg)
+        configs.extend(load_fragment(config['file']))
     elif 'dir' in config:
         # TODO: take subdirectories into account. or not
+        file_paths = []
         for entry in sorted(listdir(config['dir']), key=lambda s: s.lower()):
             file_path = path.join(config['dir'], entry)
             if not path.isfile(file_path) \
                     or entry[0] == '.':
                 continue
-            cfg = {'file': file_path}
-            configs.extend(b3_config(cfg))
+            file_paths.append(file_path)
+        # files that were already read don't need another thread
+        fragments = dict((f, cached_fragment(f)) for f in file_paths)
+        missing = [f for f in file_paths if fragments[f] is None]
+        if len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=min(FRAGMENT_CONCURRENCY,
+                    len(missing))) as executor:
+                fragments.update(zip(missing,
+                    executor.map(load_fragment, missing)))
+        else:
+            fragments.update((f, load_fragment(f)) for f in missing)
+        for file_path in file_paths:
+            configs.extend(fragments[file_path])
     else:
         # nothing to do here, really. just return whatever was received
         configs.append(config) 
@@ -569,6 +866,58 @@ def b3_config(config):
     return configs
 
 
+def merge_configs(configs, overridden=None, _parent=''):
+    """Merges configurations with the same Classification into one
+
+    Configurations are merged in order: properties of later ones replace the
+    ones set by earlier ones, and nested Configurations are merged the same
+    way. The result is sorted by Classification and property name, so the
+    same settings always give the same list, however they were split
+    between files. Configurations without a Classification are kept as they
+    are, at the end. Empty Properties and Configurations are left out.
+
+    Args:
+        configs (list): configurations, as returned by b3_config()
+        overridden (list): a (classification, property, old value, new value)
+            tuple is appended to it for each property that was set more
+            than once to different values. Nested classifications are
+            joined with '/'
+
+    Returns:
+        list of merged configurations
+    """
+    merged = {}
+    unclassified = []
+    for config in configs:
+        classification = config.get('Classification')
+        if classification is None:
+            unclassified.append(config)
+            continue
+        name = _parent + classification
+        entry = merged.setdefault(classification,
+                {'Properties': {}, 'Configurations': []})
+        for key, value in (config.get('Properties') or {}).items():
+            old = entry['Properties'].get(key)
+            if key in entry['Properties'] and old != value \
+                    and overridden is not None:
+                overridden.append((name, key, old, value))
+            entry['Properties'][key] = value
+        entry['Configurations'].extend(config.get('Configurations') or [])
+
+    result = []
+    for classification in sorted(merged):
+        entry = merged[classification]
+        config = OrderedDict([('Classification', classification)])
+        if entry['Configurations']:
+            config['Configurations'] = merge_configs(entry['Configurations'],
+                    overridden, _parent + classification + '/')
+        if entry['Properties']:
+            config['Properties'] = OrderedDict(
+                    sorted(entry['Properties'].items()))
+        result.append(config)
+    return result + unclassified
+
+
 if __name__ == "__main__":
     # execute only if run as a script
     main()
@@ -0,0 +1,788 @@
+from __future__ import unicode_literals
+
+import json
+import random
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from email.utils import formatdate
+from fnmatch import fnmatch
+from hashlib import md5
+from io import BytesIO
+from string import ascii_uppercase, digits
+from threading import Lock, local
+from time import sleep, time
+from xml.sax.saxutils import escape
+
+import boto3
+import botocore.session
+from botocore import xform_name
+from botocore.awsrequest import AWSResponse
+
+import awslib
+
+DEFAULT_REGION = 'us-east-1'
+ACCOUNT_ID = '123456789012'
+# page sizes, as AWS does them
+LIST_CLUSTERS_PAGE = 50
+LIST_STEPS_PAGE = 50
+GET_RESOURCES_PAGE = 50
+LIST_OBJECTS_PAGE = 1000
+RELEASE_LABELS_PAGE = 50
+RELEASE_LABELS = ['emr-{}'.format(version) for version in [
+    '5.36.2', '6.9.1', '6.10.1', '6.15.0', '7.0.0', '7.1.0', '7.2.0']]
+# Amazon Linux images every region has, for describe_images
+IMAGES = [
+    ('amzn2-ami-hvm-2.0.20240109.0-x86_64-gp2', 'x86_64', '2024-01-09'),
+    ('amzn2-ami-hvm-2.0.20240620.0-x86_64-gp2', 'x86_64', '2024-06-20'),
+    ('amzn2-ami-hvm-2.0.20240620.0-arm64-gp2', 'arm64', '2024-06-20'),
+    ('al2023-ami-2023.5.20240624.0-kernel-6.1-x86_64', 'x86_64',
+        '2024-06-24'),
+]
+# made up clusters: how old they can be, their states and tags
+FLEET_MAX_AGE = 60 * 24 * 3600
+FLEET_STATES = ['WAITING'] * 3 + ['TERMINATED'] * 6 \
+        + ['TERMINATED_WITH_ERRORS']
+FLEET_TEAMS = ['analytics', 'data', 'ml', 'reporting', 'search']
+# the error each service answers with when it throttles a call
+THROTTLING_ERRORS = {
+    'emr': ('ThrottlingException', 400),
+    'resource-groups-tagging-api': ('ThrottledException', 400),
+    's3': ('SlowDown', 503),
+    'ec2': ('RequestLimitExceeded', 503),
+}
+# services by the name of the methods implementing their operations
+SERVICE_PREFIXES = {
+    'emr': 'emr',
+    'resource-groups-tagging-api': 'tagging',
+    's3': 's3',
+    'ec2': 'ec2',
+}
+
+
+class FakeError(Exception):
+    """An error response, as AWS would send it"""
+
+    def __init__(self, code, message='', status=400):
+        super(FakeError, self).__init__(message or code)
+        self.code = code
+        self.message = message or code
+        self.status = status
+
+
+class FakeSession(boto3.session.Session):
+    """A boto3 session whose API calls are answered by a FakeAWS
+
+    Clients are real boto3 clients: parameters are validated, paginators,
+    retries and event handlers work as usual. Only the HTTP requests never
+    leave the process, see FakeAWS.
+    """
+
+    def __init__(self, fake, profile=None, region=None):
+        core = botocore.session.Session()
+        # request bodies are sent as they are, not aws-chunked
+        core.set_config_variable('request_checksum_calculation',
+                'when_required')
+        core.set_config_variable('response_checksum_validation',
+                'when_required')
+        super(FakeSession, self).__init__(aws_access_key_id='fake',
+                aws_secret_access_key='fake', botocore_session=core,
+                region_name=region or DEFAULT_REGION)
+        self._profile = profile or 'default'
+        account = fake.account(self._profile, self.region_name)
+        self.events.register('before-parameter-build', fake._remember)
+        self.events.register('before-send',
+                lambda **kwargs: fake._send(account, **kwargs))
+
+    @property
+    def profile_name(self):
+        return self._profile
+
+
+class _Body(BytesIO):
+    """HTTP response body, readable like the one urllib3 returns"""
+
+    def stream(self, **kwargs):
+        yield self.read()
+
+
+class FakeAWS(object):
+    """Stands in for the parts of EMR, S3, EC2 and the tagging API emrer uses
+
+    Every profile/region pair is a separate account with its own clusters
+    and objects, made when a session first asks for it. New accounts get
+    fleet_size made up clusters, spread over the last FLEET_MAX_AGE
+    seconds, tagged with emr_unique_name, team and env.
+
+    Calls go through boto3 up to the moment a request would be sent. It's
+    answered from memory instead, after 'latency' seconds. A call is
+    throttled with probability 'throttle_rate', or when its operation gets
+    more than 'rate_limit' calls per second in an account, like AWS does.
+    botocore then retries it as it would retry a real throttled call.
+
+    Clusters go through their states on their own: they are ready
+    start_seconds after run_job_flow, each step takes step_seconds, and
+    terminating takes terminate_seconds. The tagging API, eventually
+    consistent, only knows about a cluster tagging_seconds after it was
+    created. Operations in 'denied' fail with AccessDeniedException, like
+    for a user without the permission. All HTTP requests are counted in
+    'requests', by service and operation.
+
+    Args:
+        latency (float): seconds each request takes
+        throttle_rate (float): part of the requests that are throttled
+        rate_limit (float): calls per second allowed for each operation,
+            None for no limit
+        fleet_size (int): clusters each new account starts with
+        start_seconds, step_seconds, terminate_seconds, tagging_seconds
+            (float): see above
+        denied (list): names of the operations that aren't allowed, like
+            'GetResources'
+        seed: seed for everything random, for runs that can be repeated
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, rate_limit=None,
+            fleet_size=0, start_seconds=0.0, step_seconds=0.0,
+            terminate_seconds=0.0, tagging_seconds=0.0, denied=(),
+            seed=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.fleet_size = fleet_size
+        self.start_seconds = start_seconds
+        self.step_seconds = step_seconds
+        self.terminate_seconds = terminate_seconds
+        self.tagging_seconds = tagging_seconds
+        self.denied = set(denied)
+        self.requests = Counter()
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._local = local()
+        self._accounts = {}
+        self._buckets = {}
+
+    def session(self, profile=None, region=None):
+        """Returns a session for a profile and region, see FakeSession
+
+        Has the signature awslib.set_session_factory() expects.
+        """
+        return FakeSession(self, profile, region)
+
+    def account(self, profile, region):
+        """Returns the state of an account, made on first use"""
+        with self._lock:
+            key = (profile, region)
+            if key not in self._accounts:
+                self._accounts[key] = {
+                    'region': region,
+                    'clusters': OrderedDict(),
+                    'objects': {},
+                    'multipart': {},
+                }
+                self._populate(self._accounts[key], self.fleet_size)
+            return self._accounts[key]
+
+    def _populate(self, account, count):
+        now = time()
+        created = sorted(now - self._random.uniform(0, FLEET_MAX_AGE)
+                for _ in range(count))
+        for i, creation in enumerate(created):
+            state = self._random.choice(FLEET_STATES)
+            cluster = self._new_cluster(account, {
+                'Name': 'fleet cluster {}'.format(i),
+                'ReleaseLabel': self._random.choice(RELEASE_LABELS),
+                'Instances': {'KeepJobFlowAliveWhenNoSteps': True},
+                'Tags': [
+                    {'Key': 'emr_unique_name',
+                        'Value': 'fleet-{:05d}'.format(i)},
+                    {'Key': 'team',
+                        'Value': self._random.choice(FLEET_TEAMS)},
+                    {'Key': 'env',
+                        'Value': self._random.choice(['dev', 'prod'])},
+                ],
+            }, creation)
+            cluster['Status']['State'] = state
+            if state.startswith('TERMINATED'):
+                cluster['Status']['Timeline']['EndDateTime'] = min(now,
+                        creation + self._random.uniform(600, 86400))
+
+    def _new_id(self, prefix):
+        return prefix + ''.join(self._random.choice(ascii_uppercase + digits)
+                for _ in range(13))
+
+    def _new_cluster(self, account, params, created):
+        cluster_id = self._new_id('j-')
+        instances = params.get('Instances', {})
+        cluster = {
+            'Id': cluster_id,
+            'Name': params['Name'],
+            'Status': {
+                'State': 'STARTING',
+                'StateChangeReason': {},
+                'Timeline': {'CreationDateTime': created},
+            },
+            'ClusterArn': 'arn:aws:elasticmapreduce:{}:{}:cluster/{}'.format(
+                account['region'], ACCOUNT_ID, cluster_id),
+            'ReleaseLabel': params.get('ReleaseLabel', RELEASE_LABELS[-1]),
+            'LogUri': params.get('LogUri', ''),
+            'Applications': params.get('Applications', []),
+            'Tags': list(params.get('Tags', [])),
+            'AutoTerminate': not instances.get(
+                'KeepJobFlowAliveWhenNoSteps', False),
+            'TerminationProtected': instances.get('TerminationProtected',
+                False),
+            'VisibleToAllUsers': params.get('VisibleToAllUsers', True),
+            'StepConcurrencyLevel': params.get('StepConcurrencyLevel', 1),
+            'NormalizedInstanceHours': 0,
+        }
+        if 'CustomAmiId' in params:
+            cluster['CustomAmiId'] = params['CustomAmiId']
+        account['clusters'][cluster_id] = cluster
+        # the fake's own bookkeeping, never returned: the steps, when the
+        # cluster is ready and when its last step event happened
+        cluster['_steps'] = []
+        cluster['_ready'] = created + self.start_seconds
+        cluster['_clock'] = cluster['_ready']
+        return cluster
+
+    def _advance(self, cluster, now):
+        """Moves a cluster and its steps to where they are at 'now'"""
+        status = cluster['Status']
+        if status['State'] in ['STARTING', 'BOOTSTRAPPING']:
+            if now < cluster['_ready']:
+                return
+            status['Timeline']['ReadyDateTime'] = cluster['_ready']
+            status['State'] = 'RUNNING'
+        if status['State'] == 'TERMINATING' and now >= cluster['_ended']:
+            status['State'] = 'TERMINATED'
+            status['Timeline']['EndDateTime'] = cluster['_ended']
+        if status['State'] not in ['RUNNING', 'WAITING']:
+            return
+
+        steps = cluster['_steps']
+        clock = cluster['_clock']
+        while True:
+            running = [step for step in steps
+                    if step['Status']['State'] == 'RUNNING']
+            pending = [step for step in steps
+                    if step['Status']['State'] == 'PENDING']
+            for step in pending[:cluster['StepConcurrencyLevel']
+                    - len(running)]:
+                timeline = step['Status']['Timeline']
+                timeline['StartDateTime'] = max(clock,
+                        timeline['CreationDateTime'])
+                step['Status']['State'] = 'RUNNING'
+                step['_end'] = timeline['StartDateTime'] + self.step_seconds
+                running.append(step)
+            if not running or min(step['_end'] for step in running) > now:
+                break
+            clock = min(step['_end'] for step in running)
+            for step in running:
+                if step['_end'] <= clock:
+                    step['Status']['State'] = 'COMPLETED'
+                    step['Status']['Timeline']['EndDateTime'] = clock
+        cluster['_clock'] = clock
+
+        if running:
+            status['State'] = 'RUNNING'
+        elif cluster['AutoTerminate']:
+            status['State'] = 'TERMINATED'
+            status['StateChangeReason'] = {'Code': 'ALL_STEPS_COMPLETED'}
+            status['Timeline']['EndDateTime'] = clock
+        else:
+            status['State'] = 'WAITING'
+
+    def _remember(self, params, model, **kwargs):
+        # the parameters of the call, before they are turned into HTTP
+        self._local.call = (model, dict(params))
+
+    def _throttled(self, account, operation):
+        with self._lock:
+            if self.throttle_rate \
+                    and self._random.random() < self.throttle_rate:
+                return True
+            if not self.rate_limit:
+                return False
+            # a token bucket per operation, 'rate_limit' calls of burst
+            now = time()
+            key = (id(account), operation)
+            tokens, last = self._buckets.get(key, (self.rate_limit, now))
+            tokens = min(self.rate_limit,
+                    tokens + (now - last) * self.rate_limit)
+            throttled = tokens < 1
+            self._buckets[key] = (tokens if throttled else tokens - 1, now)
+            return throttled
+
+    def _send(self, account, request, event_name, **kwargs):
+        service = event_name.split('.')[1]
+        model, params = self._local.call
+        with self._lock:
+            self.requests['{}.{}'.format(service, model.name)] += 1
+        if self.latency:
+            sleep(self.latency)
+
+        protocol = model.service_model.resolved_protocol
+        try:
+            if self._throttled(account, model.name):
+                code, status = THROTTLING_ERRORS.get(service,
+                        ('Throttling', 400))
+                raise FakeError(code, 'Rate exceeded', status)
+            if model.name in self.denied:
+                raise FakeError('AccessDeniedException', 'User is not '
+                        'authorized to perform: {}'.format(model.name))
+            handler = getattr(self, '_{}_{}'.format(
+                SERVICE_PREFIXES.get(service, service), xform_name(model.name)),
+                None)
+            if handler is None:
+                raise FakeError('InvalidAction', '{} is not implemented by '
+                        'fakeaws'.format(model.name))
+            body = request.body
+            if hasattr(body, 'read'):
+                body = body.read()
+            with self._lock:
+                result = handler(account, params, body or b'')
+        except FakeError as e:
+            return _error_response(request, protocol, e)
+        return _response(request, model, result or {})
+
+    # EMR
+
+    def _cluster(self, account, cluster_id, now=None):
+        if cluster_id not in account['clusters']:
+            raise FakeError('InvalidRequestException',
+                    'Cluster id \'{}\' is not valid.'.format(cluster_id))
+        cluster = account['clusters'][cluster_id]
+        self._advance(cluster, now or time())
+        return cluster
+
+    def _emr_run_job_flow(self, account, params, body):
+        now = time()
+        cluster = self._new_cluster(account, params, now)
+        try:
+            self._add_steps(cluster, params.get('Steps', []), now)
+        except FakeError:
+            del account['clusters'][cluster['Id']]
+            raise
+        self._advance(cluster, now)
+        return {'JobFlowId': cluster['Id'], 'ClusterArn': cluster['ClusterArn']}
+
+    def _emr_describe_cluster(self, account, params, body):
+        return {'Cluster': _public(self._cluster(account,
+            params['ClusterId']))}
+
+    def _emr_list_clusters(self, account, params, body):
+        now = time()
+        after = _epoch(params.get('CreatedAfter'), float('-inf'))
+        before = _epoch(params.get('CreatedBefore'), float('inf'))
+        states = params.get('ClusterStates') or []
+        # newest first. the marker is where the next page starts, going
+        # backwards, so a page only looks at the clusters it returns
+        clusters = list(account['clusters'].values())
+        position = int(params.get('Marker') or len(clusters))
+        page = []
+        while position > 0:
+            cluster = clusters[position - 1]
+            created = cluster['Status']['Timeline']['CreationDateTime']
+            if after <= created <= before:
+                self._advance(cluster, now)
+                if not states or cluster['Status']['State'] in states:
+                    if len(page) == LIST_CLUSTERS_PAGE:
+                        break
+                    page.append(cluster)
+            position -= 1
+        result = {'Clusters': [dict((key, cluster[key]) for key in
+            ['Id', 'Name', 'Status', 'NormalizedInstanceHours', 'ClusterArn'])
+            for cluster in page]}
+        if position > 0:
+            result['Marker'] = str(position)
+        return result
+
+    def _emr_terminate_job_flows(self, account, params, body):
+        now = time()
+        clusters = [self._cluster(account, cluster_id, now)
+                for cluster_id in params['JobFlowIds']]
+        for cluster in clusters:
+            status = cluster['Status']
+            # protected clusters are left alone, without an error
+            if cluster['TerminationProtected'] or status['State'] in \
+                    ['TERMINATING', 'TERMINATED', 'TERMINATED_WITH_ERRORS']:
+                continue
+            status['State'] = 'TERMINATING'
+            status['StateChangeReason'] = {'Code': 'USER_REQUEST'}
+            cluster['_ended'] = now + self.terminate_seconds
+            for step in cluster['_steps']:
+                if step['Status']['State'] in ['PENDING', 'RUNNING']:
+                    step['Status']['State'] = 'CANCELLED'
+            self._advance(cluster, now)
+
+    def _emr_set_termination_protection(self, account, params, body):
+        for cluster_id in params['JobFlowIds']:
+            self._cluster(account, cluster_id)['TerminationProtected'] = \
+                    params['TerminationProtected']
+
+    def _emr_set_keep_job_flow_alive_when_no_steps(self, account, params,
+            body):
+        for cluster_id in params['JobFlowIds']:
+            self._cluster(account, cluster_id)['AutoTerminate'] = \
+                    not params['KeepJobFlowAliveWhenNoSteps']
+
+    def _emr_add_tags(self, account, params, body):
+        cluster = self._cluster(account, params['ResourceId'])
+        keys = [tag['Key'] for tag in params['Tags']]
+        cluster['Tags'] = [tag for tag in cluster['Tags']
+                if tag['Key'] not in keys] + list(params['Tags'])
+
+    def _emr_remove_tags(self, account, params, body):
+        cluster = self._cluster(account, params['ResourceId'])
+        cluster['Tags'] = [tag for tag in cluster['Tags']
+                if tag['Key'] not in params['TagKeys']]
+
+    def _add_steps(self, cluster, steps, now):
+        if cluster['StepConcurrencyLevel'] > 1 and any(
+                step.get('ActionOnFailure') in
+                ['TERMINATE_CLUSTER', 'TERMINATE_JOB_FLOW', 'CANCEL_AND_WAIT']
+                for step in steps):
+            raise FakeError('ValidationException', 'Only CONTINUE is '
+                    'supported as ActionOnFailure when StepConcurrencyLevel '
+                    'is greater than 1.')
+        step_ids = []
+        for step in steps:
+            step_id = self._new_id('s-')
+            cluster['_steps'].append({
+                'Id': step_id,
+                'Name': step['Name'],
+                'Config': dict(step['HadoopJarStep'], Properties={}),
+                'ActionOnFailure': step.get('ActionOnFailure', 'CONTINUE'),
+                'Status': {
+                    'State': 'PENDING',
+                    'StateChangeReason': {},
+                    'Timeline': {'CreationDateTime': now},
+                },
+            })
+            step_ids.append(step_id)
+        return step_ids
+
+    def _emr_add_job_flow_steps(self, account, params, body):
+        now = time()
+        cluster = self._cluster(account, params['JobFlowId'], now)
+        if cluster['Status']['State'] not in \
+                ['STARTING', 'BOOTSTRAPPING', 'RUNNING', 'WAITING']:
+            raise FakeError('ValidationException', 'A job flow that is '
+                    'shutting down, terminated, or finished may not be '
+                    'modified.')
+        step_ids = self._add_steps(cluster, params['Steps'], now)
+        self._advance(cluster, now)
+        return {'StepIds': step_ids}
+
+    def _emr_list_steps(self, account, params, body):
+        cluster = self._cluster(account, params['ClusterId'])
+        states = params.get('StepStates') or []
+        step_ids = params.get('StepIds') or []
+        found = [_public(step) for step in reversed(cluster['_steps'])
+                if (not states or step['Status']['State'] in states)
+                and (not step_ids or step['Id'] in step_ids)]
+        start = int(params.get('Marker') or 0)
+        result = {'Steps': found[start:start + LIST_STEPS_PAGE]}
+        if start + LIST_STEPS_PAGE < len(found):
+            result['Marker'] = str(start + LIST_STEPS_PAGE)
+        return result
+
+    def _emr_list_release_labels(self, account, params, body):
+        prefix = params.get('Filters', {}).get('Prefix', '')
+        labels = [label for label in reversed(RELEASE_LABELS)
+                if label.startswith(prefix)]
+        start = int(params.get('NextToken') or 0)
+        size = params.get('MaxResults', RELEASE_LABELS_PAGE)
+        result = {'ReleaseLabels': labels[start:start + size]}
+        if start + size < len(labels):
+            result['NextToken'] = str(start + size)
+        return result
+
+    # resource groups tagging API
+
+    def _tagging_get_resources(self, account, params, body):
+        types = params.get('ResourceTypeFilters') or []
+        if types and 'elasticmapreduce:cluster' not in types \
+                and 'elasticmapreduce' not in types:
+            return {'ResourceTagMappingList': []}
+        filters = params.get('TagFilters') or []
+        size = params.get('ResourcesPerPage', GET_RESOURCES_PAGE)
+        # the token is where the next page starts
+        clusters = list(account['clusters'].values())
+        position = int(params.get('PaginationToken') or 0)
+        page = []
+        known_before = time() - self.tagging_seconds
+        while position < len(clusters):
+            cluster = clusters[position]
+            tags = dict((tag['Key'], tag['Value']) for tag in cluster['Tags'])
+            created = cluster['Status']['Timeline']['CreationDateTime']
+            if created <= known_before and all(tag_filter['Key'] in tags and (
+                    not tag_filter.get('Values')
+                    or tags[tag_filter['Key']] in tag_filter['Values'])
+                    for tag_filter in filters):
+                if len(page) == size:
+                    break
+                page.append({'ResourceARN': cluster['ClusterArn'],
+                    'Tags': cluster['Tags']})
+            position += 1
+        result = {'ResourceTagMappingList': page, 'PaginationToken': ''}
+        if position < len(clusters):
+            result['PaginationToken'] = str(position)
+        return result
+
+    # S3
+
+    def _object(self, account, params):
+        key = (params['Bucket'], params['Key'])
+        if key not in account['objects']:
+            raise FakeError('NoSuchKey', 'The specified key does not exist.',
+                    404)
+        return account['objects'][key]
+
+    def _s3_put_object(self, account, params, body):
+        account['objects'][(params['Bucket'], params['Key'])] = {
+            'body': body,
+            'etag': '"{}"'.format(md5(body).hexdigest()),
+            'metadata': params.get('Metadata', {}),
+            'modified': time(),
+        }
+        return {'ETag': account['objects'][
+            (params['Bucket'], params['Key'])]['etag']}
+
+    def _s3_head_object(self, account, params, body):
+        try:
+            found = self._object(account, params)
+        except FakeError:
+            # HEAD responses have no body, so no error code either
+            raise FakeError('404', 'Not Found', 404)
+        return {'ETag': found['etag'], 'ContentLength': len(found['body']),
+                'LastModified': found['modified'],
+                'Metadata': found['metadata']}
+
+    def _s3_get_object(self, account, params, body):
+        found = self._object(account, params)
+        data = found['body']
+        if params.get('Range', '').startswith('bytes='):
+            start = int(params['Range'][len('bytes='):].split('-')[0])
+            if start >= len(data) and data:
+                raise FakeError('InvalidRange', 'The requested range is not '
+                        'satisfiable', 416)
+            data = data[start:]
+        return {'Body': data, 'ETag': found['etag'],
+                'ContentLength': len(data), 'LastModified': found['modified'],
+                'Metadata': found['metadata']}
+
+    def _s3_list_objects_v2(self, account, params, body):
+        prefix = params.get('Prefix', '')
+        keys = sorted(key for bucket, key in account['objects']
+                if bucket == params['Bucket'] and key.startswith(prefix))
+        start = int(params.get('ContinuationToken') or 0)
+        size = params.get('MaxKeys', LIST_OBJECTS_PAGE)
+        page = keys[start:start + size]
+        result = {
+            'Contents': [{
+                'Key': key,
+                'Size': len(account['objects'][(params['Bucket'], key)][
+                    'body']),
+                'ETag': account['objects'][(params['Bucket'], key)]['etag'],
+                'LastModified': account['objects'][(params['Bucket'], key)][
+                    'modified'],
+            } for key in page],
+            'KeyCount': len(page),
+            'IsTruncated': start + size < len(keys),
+        }
+        if result['IsTruncated']:
+            result['NextContinuationToken'] = str(start + size)
+        return result
+
+    def _s3_create_multipart_upload(self, account, params, body):
+        upload_id = self._new_id('')
+        account['multipart'][upload_id] = {'params': params, 'parts': {}}
+        return {'Bucket': params['Bucket'], 'Key': params['Key'],
+                'UploadId': upload_id}
+
+    def _multipart(self, account, params):
+        if params['UploadId'] not in account['multipart']:
+            raise FakeError('NoSuchUpload', 'The specified upload does not '
+                    'exist.', 404)
+        return account['multipart'][params['UploadId']]
+
+    def _s3_upload_part(self, account, params, body):
+        self._multipart(account, params)['parts'][params['PartNumber']] = body
+        return {'ETag': '"{}"'.format(md5(body).hexdigest())}
+
+    def _s3_complete_multipart_upload(self, account, params, body):
+        upload = account['multipart'].pop(params['UploadId'], None)
+        if upload is None:
+            raise FakeError('NoSuchUpload', 'The specified upload does not '
+                    'exist.', 404)
+        parts = [upload['parts'][number]
+                for number in sorted(upload['parts'])]
+        digests = b''.join(md5(part).digest() for part in parts)
+        etag = '"{}-{}"'.format(md5(digests).hexdigest(), len(parts))
+        account['objects'][(params['Bucket'], params['Key'])] = {
+            'body': b''.join(parts),
+            'etag': etag,
+            'metadata': upload['params'].get('Metadata', {}),
+            'modified': time(),
+        }
+        return {'Bucket': params['Bucket'], 'Key': params['Key'],
+                'ETag': etag}
+
+    def _s3_abort_multipart_upload(self, account, params, body):
+        account['multipart'].pop(params['UploadId'], None)
+
+    # EC2
+
+    def _ec2_describe_images(self, account, params, body):
+        fields = {'name': 'Name', 'architecture': 'Architecture',
+                'root-device-type': 'RootDeviceType',
+                'virtualization-type': 'VirtualizationType',
+                'state': 'State', 'image-id': 'ImageId'}
+        images = []
+        for i, (name, architecture, created) in enumerate(IMAGES):
+            images.append({
+                'ImageId': 'ami-{:017x}'.format(i + 1),
+                'Name': name,
+                'Architecture': architecture,
+                'RootDeviceType': 'ebs',
+                'VirtualizationType': 'hvm',
+                'State': 'available',
+                'CreationDate': created + 'T00:00:00.000Z',
+                'OwnerId': '137112412989',
+                'ImageOwnerAlias': 'amazon',
+            })
+        for image_filter in params.get('Filters', []):
+            field = fields.get(image_filter['Name'])
+            if field is None:
+                continue
+            images = [image for image in images
+                    if any(fnmatch(image[field], value)
+                        for value in image_filter['Values'])]
+        return {'Images': images}
+
+
+def _public(item):
+    """A copy of a record without the fake's own _keys"""
+    return dict((key, value) for key, value in item.items()
+            if not key.startswith('_'))
+
+
+def _epoch(value, default):
+    if value is None:
+        return default
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return (value - datetime(1970, 1, 1,
+            tzinfo=timezone.utc)).total_seconds()
+    return float(value)
+
+
+def _iso(value):
+    return datetime.fromtimestamp(value, timezone.utc).isoformat()
+
+
+def _xml(shape, value, name):
+    """Serializes a value as XML, for the rest-xml and ec2 protocols"""
+    if shape.type_name == 'structure':
+        inner = ''.join(_xml(member, value[member_name],
+            member.serialization.get('name', member_name))
+            for member_name, member in shape.members.items()
+            if member_name in value
+            and not member.serialization.get('location'))
+    elif shape.type_name == 'list':
+        member = shape.member
+        if shape.serialization.get('flattened'):
+            return ''.join(_xml(member, item,
+                member.serialization.get('name', name)) for item in value)
+        inner = ''.join(_xml(member, item,
+            member.serialization.get('name', 'member')) for item in value)
+    elif shape.type_name == 'timestamp':
+        inner = _iso(value)
+    elif shape.type_name == 'boolean':
+        inner = 'true' if value else 'false'
+    else:
+        inner = escape('{}'.format(value))
+    return '<{0}>{1}</{0}>'.format(name, inner)
+
+
+def _response(request, model, result):
+    """Turns what an operation returned into the HTTP response AWS sends"""
+    protocol = model.service_model.resolved_protocol
+    shape = model.output_shape
+    headers = {'x-amzn-RequestId': 'fakeaws'}
+    status = 200
+    if protocol == 'json':
+        body = json.dumps(result).encode('utf-8')
+    elif shape is None:
+        body = b''
+    else:
+        payload = shape.serialization.get('payload')
+        for member_name, member in shape.members.items():
+            location = member.serialization.get('location')
+            if member_name not in result or location not in \
+                    ['header', 'headers']:
+                continue
+            name = member.serialization.get('name', member_name)
+            value = result[member_name]
+            if location == 'headers':
+                for key, item in value.items():
+                    headers[name + key] = item
+            elif member.type_name == 'timestamp':
+                headers[name] = formatdate(value, usegmt=True)
+            elif member.type_name == 'boolean':
+                headers[name] = 'true' if value else 'false'
+            else:
+                headers[name] = '{}'.format(value)
+        if payload:
+            body = result.get(payload, b'')
+            if 'Range' in request.headers:
+                status = 206
+        elif any(not member.serialization.get('location')
+                for member_name, member in shape.members.items()
+                if member_name in result):
+            root = shape.serialization.get('name', model.name + 'Response')
+            body = _xml(shape, result, root).encode('utf-8')
+        else:
+            body = b''
+    headers['Content-Length'] = '{}'.format(len(body))
+    return AWSResponse(request.url, status, headers, _Body(body))
+
+
+def _error_response(request, protocol, error):
+    if protocol == 'json':
+        body = json.dumps({'__type': error.code,
+            'message': error.message}).encode('utf-8')
+    elif request.method == 'HEAD':
+        body = b''
+    elif protocol == 'ec2':
+        body = ('<Response><Errors><Error><Code>{}</Code><Message>{}'
+                '</Message></Error></Errors><RequestID>fakeaws</RequestID>'
+                '</Response>').format(error.code,
+                    escape(error.message)).encode('utf-8')
+    else:
+        body = ('<Error><Code>{}</Code><Message>{}</Message></Error>'.format(
+            error.code, escape(error.message))).encode('utf-8')
+    return AWSResponse(request.url, error.status,
+            {'x-amzn-RequestId': 'fakeaws',
+                'Content-Length': '{}'.format(len(body))}, _Body(body))
+
+
+def install(fake=None, **options):
+    """Makes awslib.get_session() return sessions of a FakeAWS
+
+    Args:
+        fake (FakeAWS): the fake to use, a new one if None
+        options: passed on to FakeAWS() when a new one is made
+
+    Returns:
+        the FakeAWS
+    """
+    fake = fake or FakeAWS(**options)
+    awslib.set_session_factory(fake.session)
+    return fake
+
+
+def uninstall():
+    """Goes back to real AWS sessions"""
+    awslib.set_session_factory(None)
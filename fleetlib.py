@@ -0,0 +1,87 @@
+from __future__ import unicode_literals
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from awslib import get_session, iter_clusters
+
+# how many AWS calls are made at the same time, for all accounts and regions
+FLEET_CONCURRENCY = 16
+
+# put in the queue by a scan when it's done
+_DONE = object()
+
+
+def fleet_targets(profiles=None, regions=None):
+    """
+    Returns every (profile, region) pair to be scanned. A missing list of
+    profiles means the default profile, a missing list of regions means
+    each profile's own region.
+    """
+    return [(profile, region)
+            for profile in (profiles or [None])
+            for region in (regions or [None])]
+
+
+async def _scan(target, queue, semaphore, executor, filters):
+    """Pages through the clusters of one profile and region
+
+    iter_clusters() makes its calls as it's iterated, so every step of the
+    iteration runs in the executor, under the semaphore. A scan that fails
+    puts the exception in the queue and ends, the other scans go on.
+    """
+    loop = asyncio.get_event_loop()
+    profile, region = target
+    try:
+        async with semaphore:
+            session = await loop.run_in_executor(executor, get_session,
+                    profile, region)
+        clusters = iter_clusters(session, **filters)
+        while True:
+            async with semaphore:
+                cluster = await loop.run_in_executor(executor, next,
+                        clusters, _DONE)
+            if cluster is _DONE:
+                break
+            await queue.put((profile, session.region_name, cluster))
+    except Exception as e:
+        await queue.put((profile, region, e))
+    finally:
+        await queue.put(_DONE)
+
+
+async def fleet_clusters(targets, concurrency=FLEET_CONCURRENCY, **filters):
+    """Lists the clusters of many profiles and regions at the same time
+
+    All profile/region pairs are scanned concurrently, and the results are
+    merged into one stream, in the order they arrive. At most 'concurrency'
+    calls are made at the same time, whatever the number of pairs, so a
+    whole fleet takes about as long as its slowest region.
+
+    Args:
+        targets (list): (profile, region) pairs, see fleet_targets()
+        concurrency (int): maximum number of AWS calls at the same time
+        filters: passed on to awslib.iter_clusters()
+
+    Yields:
+        (profile, region, cluster) tuples, cluster being a cluster summary
+        as returned by list_clusters. If a pair can't be listed, the
+        cluster is the exception instead
+    """
+    queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        scans = [asyncio.ensure_future(
+                _scan(target, queue, semaphore, executor, filters))
+                for target in targets]
+        try:
+            running = len(scans)
+            while running:
+                item = await queue.get()
+                if item is _DONE:
+                    running -= 1
+                else:
+                    yield item
+        finally:
+            for scan in scans:
+                scan.cancel()
@@ -0,0 +1,199 @@
+from __future__ import unicode_literals
+
+import codecs
+import zlib
+from itertools import chain
+from time import sleep, time
+
+from awslib import poll_interval, STEP_STATES_ACTIVE
+
+# bytes read from S3 at a time
+LOG_CHUNK_SIZE = 64 * 1024
+# bytes kept from the end of what was read, to check that an object that
+# changed still starts with what was already read
+LOG_OVERLAP = 64
+# EMR pushes step logs to S3 every 5 minutes. after the steps are done,
+# logs are followed this many seconds more, for the last push
+LOG_PUSH_SECONDS = 360
+# shortest and longest wait between two looks at the logs
+LOG_MIN_INTERVAL = 10
+LOG_MAX_INTERVAL = 60
+
+
+def parse_s3_uri(uri):
+    """Splits s3://bucket/prefix, s3n:// or s3a:// too, in bucket and prefix
+
+    The prefix always ends with '/', unless it's empty.
+    """
+    for scheme in ['s3://', 's3n://', 's3a://']:
+        if uri.startswith(scheme):
+            uri = uri[len(scheme):]
+            break
+    bucket, _, prefix = uri.partition('/')
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return bucket, prefix
+
+
+class LogObject(object):
+    """Reads an S3 object that keeps growing, one new piece at a time
+
+    EMR pushes logs to S3 every few minutes, replacing the objects with
+    longer versions. Each call to read_new() asks S3 only for the bytes
+    after the ones already read, with a range GET, and decompresses them
+    on the fly if the object is gzipped. Memory use doesn't depend on the
+    size of the object. A gzipped object made of many gzip members, one
+    per push, is read the same way.
+
+    If an object turns out to have been rewritten instead of appended to,
+    that is if the bytes just before the new ones changed, it's read again
+    from the start, skipping the text that was already returned.
+    """
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.gzipped = key.endswith('.gz')
+        self.etag = None
+        self._reset()
+        # text returned so far, survives rewrites
+        self.returned = 0
+
+    def _reset(self):
+        self.offset = 0
+        self.tail = b''
+        self.produced = 0
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) \
+                if self.gzipped else None
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def read_new(self, s3c, size, etag):
+        """Yields the text added to the object since the last call
+
+        Args:
+            s3c: S3 client
+            size (int): current size of the object, from list_objects_v2
+            etag (str): current ETag of the object
+
+        Yields:
+            pieces of text, decoded as UTF-8
+        """
+        if etag == self.etag and size == self.offset:
+            return
+        if size == 0:
+            self.etag = etag
+            return
+        if size < self.offset:
+            self._reset()
+        start = self.offset - len(self.tail)
+        response = s3c.get_object(Bucket=self.bucket, Key=self.key,
+                Range='bytes={}-'.format(start))
+        chunks = response['Body'].iter_chunks(LOG_CHUNK_SIZE)
+
+        # the bytes already read have to be the same, or start over
+        overlap = b''
+        if self.tail:
+            for chunk in chunks:
+                overlap += chunk
+                if len(overlap) >= len(self.tail):
+                    break
+            if overlap[:len(self.tail)] != self.tail:
+                response['Body'].close()
+                self._reset()
+                for text in self.read_new(s3c, size, etag):
+                    yield text
+                return
+            overlap = overlap[len(self.tail):]
+
+        for chunk in chain([overlap], chunks):
+            if not chunk:
+                continue
+            self.offset += len(chunk)
+            self.tail = (self.tail + chunk)[-LOG_OVERLAP:]
+            text = self.decoder.decode(self._decompress(chunk))
+            # after a rewrite, skip what was returned before
+            skip = max(0, min(len(text), self.returned - self.produced))
+            self.produced += len(text)
+            if len(text) > skip:
+                self.returned += len(text) - skip
+                yield text[skip:]
+        self.etag = etag
+
+    def _decompress(self, data):
+        if self.decompressor is None:
+            return data
+        out = []
+        while data:
+            out.append(self.decompressor.decompress(data))
+            # a new gzip member starts after the end of the previous one
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return b''.join(out)
+
+
+def list_log_objects(s3c, bucket, prefix):
+    """Returns {key: (size, etag)} for all objects under a prefix"""
+    objects = {}
+    paginator = s3c.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            objects[item['Key']] = (item['Size'], item['ETag'])
+    return objects
+
+
+def follow_step_logs(session, cluster_id, log_uri, step_ids=None,
+        follow=False, min_interval=LOG_MIN_INTERVAL,
+        max_interval=LOG_MAX_INTERVAL):
+    """Reads the logs of a cluster's steps, and optionally what's added later
+
+    Logs are under <log_uri>/<cluster id>/steps/<step id>/. Each look at
+    them is one listing of that prefix, then a range GET for each object
+    that grew, see LogObject. When following, looks are more frequent right
+    after new text was found. Following ends when none of the steps is
+    pending or running anymore, and no new text came for LOG_PUSH_SECONDS.
+
+    Args:
+        session (boto3.session): session to use
+        cluster_id (str): the cluster
+        log_uri (str): the cluster's log URI, s3://bucket/prefix
+        step_ids (list): only the logs of these steps, all steps if None
+        follow (bool): keep reading new text, like tail -f
+
+    Yields:
+        (key, text) tuples, key being the S3 key of the log
+    """
+    s3c = session.client('s3')
+    emr = session.client('emr')
+    bucket, prefix = parse_s3_uri(log_uri)
+    prefix = '{}{}/steps/'.format(prefix, cluster_id)
+    logs = {}
+    last_text = time()
+    while True:
+        found = False
+        for key, (size, etag) in sorted(
+                list_log_objects(s3c, bucket, prefix).items()):
+            if step_ids is not None \
+                    and key[len(prefix):].split('/')[0] not in step_ids:
+                continue
+            log = logs.setdefault(key, LogObject(bucket, key))
+            for text in log.read_new(s3c, size, etag):
+                found = True
+                yield key, text
+        if not follow:
+            return
+
+        now = time()
+        if found:
+            last_text = now
+        active = False
+        for page in emr.get_paginator('list_steps').paginate(
+                ClusterId=cluster_id, StepStates=STEP_STATES_ACTIVE):
+            if any(step_ids is None or step['Id'] in step_ids
+                    for step in page['Steps']):
+                active = True
+                break
+        if not active and now - last_text > LOG_PUSH_SECONDS:
+            return
+        sleep(poll_interval(now - last_text, None, min_interval,
+            max_interval))
@@ -0,0 +1,160 @@
+from __future__ import unicode_literals
+
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from threading import Lock, local
+from timeit import default_timer
+
+# error codes botocore treats as throttling
+THROTTLING_CODES = [
+    'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestThrottledException', 'TooManyRequestsException',
+    'ProvisionedThroughputExceededException', 'TransactionInProgressException',
+    'RequestLimitExceeded', 'BandwidthLimitExceeded', 'LimitExceededException',
+    'RequestThrottled', 'SlowDown', 'PriorRequestNotComplete',
+    'EC2ThrottledException',
+]
+
+
+class Metrics(object):
+    """Collects timings and AWS API call counts for one emrer run
+
+    Phases are timed with the phase() context manager. API calls are
+    counted by botocore event handlers registered on each session with
+    attach(): calls, HTTP requests sent (retries included), throttling
+    errors, failed calls, time spent and bytes sent, per service and
+    operation. Bytes sent to S3 are the bytes uploaded. Handlers only add
+    a few numbers under a lock, so collecting costs next to nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.action = None
+        self._lock = Lock()
+        self._local = local()
+        self.reset()
+
+    def reset(self):
+        """Forgets everything collected, to measure a new run from here"""
+        with self._lock:
+            self.started = datetime.now(timezone.utc)
+            self._start = default_timer()
+            self.phases = OrderedDict()
+            self.api = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Times a block of code, adding to the phase's total"""
+        start = default_timer()
+        try:
+            yield
+        finally:
+            elapsed = default_timer() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def attach(self, session):
+        """Registers the event handlers on a boto3 session
+
+        Must be called before clients are created, clients copy the
+        session's handlers when they are created.
+        """
+        if not self.enabled:
+            return
+        events = session.events
+        events.register('before-call', self._before_call)
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call_error)
+        events.register('needs-retry', self._needs_retry)
+        events.register('before-send', self._before_send)
+
+    def _operation(self, event_name):
+        # event names look like 'before-call.emr.ListClusters'
+        operation = '.'.join(event_name.split('.')[1:3])
+        if operation not in self.api:
+            self.api[operation] = OrderedDict([('calls', 0), ('attempts', 0),
+                ('retries', 0), ('throttles', 0), ('errors', 0),
+                ('seconds', 0.0), ('bytes_sent', 0)])
+        return self.api[operation]
+
+    def _before_call(self, event_name, **kwargs):
+        self._local.__dict__.setdefault('starts', []).append(default_timer())
+        with self._lock:
+            self._operation(event_name)['calls'] += 1
+
+    def _after_call(self, event_name, parsed=None, **kwargs):
+        elapsed = self._elapsed()
+        with self._lock:
+            operation = self._operation(event_name)
+            operation['seconds'] += elapsed
+            if 'Error' in (parsed or {}):
+                operation['errors'] += 1
+
+    def _after_call_error(self, event_name, **kwargs):
+        elapsed = self._elapsed()
+        with self._lock:
+            operation = self._operation(event_name)
+            operation['seconds'] += elapsed
+            operation['errors'] += 1
+
+    def _elapsed(self):
+        starts = self._local.__dict__.get('starts')
+        return default_timer() - starts.pop() if starts else 0.0
+
+    def _needs_retry(self, event_name, response=None, **kwargs):
+        if not response:
+            return
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLING_CODES:
+            with self._lock:
+                self._operation(event_name)['throttles'] += 1
+
+    def _before_send(self, event_name, request=None, **kwargs):
+        if request is None:
+            return
+        size = int(request.headers.get('Content-Length', 0) or 0)
+        with self._lock:
+            operation = self._operation(event_name)
+            # sent once per attempt, retries included
+            operation['attempts'] += 1
+            operation['bytes_sent'] += size
+
+    def report(self):
+        """Returns everything collected, as a dictionary"""
+        with self._lock:
+            api = OrderedDict((key, OrderedDict(self.api[key]))
+                    for key in sorted(self.api))
+            for operation in api.values():
+                operation['retries'] = max(0,
+                        operation['attempts'] - operation['calls'])
+            totals = OrderedDict((key, sum(op[key] for op in api.values()))
+                    for key in ['calls', 'attempts', 'retries', 'throttles',
+                        'errors', 'bytes_sent'])
+            return OrderedDict([
+                ('action', self.action),
+                ('started', self.started.isoformat().replace('+00:00', 'Z')),
+                ('seconds', default_timer() - self._start),
+                ('phases', OrderedDict(self.phases)),
+                ('api_totals', totals),
+                ('api', api),
+            ])
+
+    def write(self, destination):
+        """Writes the report as JSON to a file, or to stdout for '-'"""
+        report = json.dumps(self.report(), indent=2)
+        if destination == '-':
+            print(report)
+        else:
+            with open(destination, 'w') as f:
+                f.write(report + '\n')
+
+
+# one run, one set of metrics
+metrics = Metrics()
+
+
+def phase(name):
+    """Shortcut for metrics.phase(), see Metrics"""
+    return metrics.phase(name)